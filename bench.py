@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Christopher Brown
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this script.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Benchmarks for calibrate.
+
+    Usage: python bench.py [noise|import|suite|precision] [options]
+
+    With no arguments, all benchmarks are run, the suite on its quick grid.
+    See python bench.py suite -h for the suite's options.
+"""
+
+import os
+import sys
+import time
+import json
+import platform
+import argparse
+import contextlib
+import subprocess
+import tracemalloc
+
+import numpy as np
+
+import calibrate
+
+
+def time_call(func, *args, **kwargs):
+    """Returns the wall time, in s, of the fastest of three calls to func."""
+    best = None
+    for _ in range(3):
+        t0 = time.time()
+        func(*args, **kwargs)
+        t = time.time() - t0
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def bench_noise_engines(durations=(1., 10., 60., 600.), s=44100.):
+    """Compares the noise engines over a range of stimulus durations."""
+    c, w, r, a = 1000., 1/3., .18, 0.
+    print("Noise engines, {:} Hz, 1/3-octave band at {:} Hz".format(s, c))
+    header = u"{:>10}".format("dur (s)")
+    for name, _ in calibrate.NOISE_ENGINES:
+        header += u"{:>18}".format(name + " (s)")
+    print(header)
+    for d in durations:
+        row = u"{:>10}".format(d)
+        for _, engine in calibrate.NOISE_ENGINES:
+            row += u"{:>18.3f}".format(time_call(engine, c, w, r, a, d, s))
+        print(row)
+
+
+def bench_filter_bank(durations=(1., 10., 60.), s=44100.):
+    """Compares generating the 1/3-octave bands from 125 to 8000 Hz one at a time with splitting one draw in a filter bank."""
+    centers, edges = calibrate.octave_bands(1/3., calibrate.BANK_LOW, calibrate.BANK_HIGH)
+    print("Filter bank, {:} Hz, {:} 1/3-octave bands".format(s, len(centers)))
+    print(u"{:>10}{:>18}{:>18}{:>18}".format("dur (s)", "Butterworth (s)", "FFT (s)", "bank (s)"))
+    for d in durations:
+        row = u"{:>10}".format(d)
+        for _, engine in calibrate.NOISE_ENGINES:
+            row += u"{:>18.3f}".format(time_call(lambda: [engine(c, 1/3., .18, 0., d, s) for c in centers]))
+        row += u"{:>18.3f}".format(time_call(calibrate.noise_bank, edges, .18, 0., d, s))
+        print(row)
+
+
+def import_times(module):
+    """Imports module in a fresh interpreter, and returns its self and cumulative import times in s.
+
+        The times come from python -X importtime, and are returned as a list of
+        (module name, self time, cumulative time), slowest first.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.abspath(__file__)), env.get("PYTHONPATH", "")])
+    proc = subprocess.Popen([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            stderr=subprocess.PIPE, universal_newlines=True, env=env)
+    _, err = proc.communicate()
+    times = []
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            times.append((fields[2].strip(), int(fields[0]) / 1e6, int(fields[1]) / 1e6))
+        except ValueError:
+            # The header line
+            pass
+    return sorted(times, key=lambda t: -t[2])
+
+
+def bench_import(modules=("calibrate", "calibrate_ui"), top=8):
+    """Reports the time it takes to import calibrate and its menu, so startup regressions are visible."""
+    for module in modules:
+        times = import_times(module)
+        total = [t for t in times if t[0] == module]
+        print(u"import {:}: {:.3f} s".format(module, total[0][2] if total else float("nan")))
+        for name, self_t, cum_t in times[1:top+1]:
+            print(u"  {:<30}{:>10.3f} s".format(name, cum_t))
+
+
+# Stages of stimulus generation and playback setup, as done by play(). Each
+# takes a duration (s), sample rate (Hz) and bandwidth (octaves), and returns a
+# function that runs the stage once. Work done before returning, such as drawing
+# the noise that a filter stage filters, is not measured.
+
+def stage_tone_stream(d, s, w):
+    def run():
+        for block in calibrate.tone_blocks(1000., 1., d, s):
+            pass
+    return run
+
+
+def stage_tone_render(d, s, w):
+    return lambda: np.concatenate(list(calibrate.tone_blocks(1000., 1., d, s)))
+
+
+def stage_noise_draw(d, s, w):
+    n = int(d*s)
+    return lambda: calibrate.fill_randn(np.empty(n, calibrate.DTYPE), 1)
+
+
+def stage_butter_filter(d, s, w):
+    signal = calibrate.fill_randn(np.empty(int(d*s), calibrate.DTYPE), 1)
+    return lambda: calibrate.butter_filter(signal, 1000., w, s)
+
+
+def stage_butter_stream(d, s, w):
+    def run():
+        for block in calibrate.butter_noise_blocks(1000., w, .18, 0., d, s):
+            pass
+    return run
+
+
+def stage_fft_noise(d, s, w):
+    return lambda: calibrate.fft_noise(1000., w, .18, 0., d, s)
+
+
+def stage_ramps(d, s, w):
+    signal = np.ones(int(d*s))
+    ramp = calibrate.hanning_ramp(s)
+    return lambda: calibrate.apply_ramps(signal, 0, len(signal), ramp)
+
+
+def stage_playback_setup(d, s, w):
+    signal = np.zeros(int(d*s))
+    def run():
+        # Open a device and stream, prime the ring and start it, as play() does
+        pool = calibrate.DevicePool()
+        dev = pool.get(0, 2, s)
+        player = calibrate.BlockPlayer(dev, calibrate.array_blocks(signal), s, total=len(signal))
+        player.play()
+        player.stop(fade=False)
+        player.wait()
+        pool.close_all()
+    return run
+
+
+# name: (stage, whether it renders the whole stimulus, whether bandwidth matters)
+STAGES = [
+    ("tone_stream", stage_tone_stream, False, False),
+    ("tone_render", stage_tone_render, True, False),
+    ("noise_draw", stage_noise_draw, True, False),
+    ("butter_filter", stage_butter_filter, True, True),
+    ("butter_stream", stage_butter_stream, False, True),
+    ("fft_noise", stage_fft_noise, True, True),
+    ("ramps", stage_ramps, False, False),
+    ("playback_setup", stage_playback_setup, False, False),
+]
+
+QUICK_GRID = {
+    "durations": [1., 10., 60.],
+    "rates": [44100., 96000.],
+    "bandwidths": [1/3., 1.],
+}
+
+FULL_GRID = {
+    "durations": [1., 10., 60., 600., 1800.],
+    "rates": [22050., 44100., 48000., 96000., 192000.],
+    "bandwidths": [1/3., 1., 3.],
+}
+
+
+def measure(run, repeat):
+    """Runs a stage, and returns its wall time in s (the fastest of repeat runs) and its memory use.
+
+        Memory is measured on a separate run, with tracemalloc, so that tracing
+        doesn't inflate the time. peak_bytes is the most memory the stage held
+        at once; alloc_bytes and alloc_blocks are the memory, and the number of
+        blocks, it allocated and still held on return (ie., its result).
+    """
+    wall = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        run()
+        t = time.perf_counter() - t0
+        if wall is None or t < wall:
+            wall = t
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        result = run()
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # Leave out tracemalloc's own bookkeeping
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    diff = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "filename")
+    del result
+    return {
+        "wall_s": wall,
+        "peak_bytes": peak,
+        "alloc_bytes": sum(st.size_diff for st in diff if st.size_diff > 0),
+        "alloc_blocks": sum(st.count_diff for st in diff if st.count_diff > 0),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextlib.contextmanager
+def null_playback():
+    """Plays stimuli through calibrate's NullBackend, and leaves their timings out of the log, inside the block.
+
+        The backend and timing log are put back afterwards, even if the block raises.
+    """
+    backend, timing_log = calibrate._backend, calibrate.TIMING_LOG
+    calibrate.use_backend(calibrate.NullBackend())
+    calibrate.set_timing_log(None)
+    try:
+        yield
+    finally:
+        calibrate.use_backend(backend)
+        calibrate.set_timing_log(timing_log)
+
+
+def bench_suite(durations, rates, bandwidths, stages=None, max_samples=2**26, json_file=None):
+    """Times every stage over a grid of durations, sample rates and bandwidths.
+
+        Stages that render the whole stimulus are skipped when it would be longer
+        than max_samples. Playback runs against calibrate's NullBackend, so no
+        audio hardware is needed, and its timings aren't logged. Results are
+        printed, and if json_file is given, written to it along with details
+        of the machine and revision.
+    """
+    import scipy
+    results = []
+    with null_playback():
+        print(u"{:<16}{:>9}{:>10}{:>7}{:>11}{:>11}{:>10}".format(
+            "stage", "dur (s)", "rate (Hz)", "bw", "wall (s)", "peak (MB)", "blocks"))
+        for name, stage, renders, banded in STAGES:
+            if stages and name not in stages:
+                continue
+            for d in durations:
+                for s in rates:
+                    for w in (bandwidths if banded else [None]):
+                        samples = int(d*s)
+                        row = {"stage": name, "duration": d, "rate": s, "bandwidth": w, "samples": samples}
+                        if renders and samples > max_samples:
+                            row["skipped"] = True
+                        else:
+                            repeat = 3 if samples <= 10**7 else 1
+                            row.update(measure(stage(d, s, w or 1/3.), repeat))
+                        results.append(row)
+                        if row.get("skipped"):
+                            cols = (u"skipped", u"", u"")
+                        else:
+                            cols = (u"{:.4g}".format(row["wall_s"]), u"{:.1f}".format(row["peak_bytes"] / 2.**20),
+                                    row["alloc_blocks"])
+                        print(u"{:<16}{:>9}{:>10}{:>7}{:>11}{:>11}{:>10}".format(
+                            name, d, s, u"" if w is None else u"{:.2f}".format(w), *cols))
+    if json_file:
+        meta = {
+            "revision": git_revision(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "block_size": calibrate.BLOCK_SIZE,
+        }
+        with open(json_file, "w") as fid:
+            json.dump({"meta": meta, "results": results}, fid, indent=1)
+    return results
+
+
+def tone_frequency(signal, s):
+    """Estimates the frequency, in Hz, of a tone from the slope of its unwrapped analytic phase."""
+    phase = np.unwrap(np.angle(calibrate.scipy_signal().hilbert(signal)))
+    # Leave out the ends, where the hilbert transform wraps around
+    n = len(signal) // 10
+    t = np.arange(n, len(signal) - n) / s
+    return np.polyfit(t, phase[n:len(signal)-n], 1)[0] / (2. * np.pi)
+
+
+def bench_precision(d=1800., s=44100., f=1000., c=1000., w=1/3., noise_d=60.):
+    """Checks that float32 generation keeps the tone frequency and noise band edges within spec.
+
+        The tone is generated in blocks for d seconds, and its frequency is
+        measured over the last second, where any phase drift would have built up.
+        Each noise engine is checked over noise_d seconds, against the edges of
+        its design: the Butterworth filters' response, or the nominal band for the
+        FFT engine. Both are done in float32 and float64, and the float32 tone is
+        also compared sample by sample with the float64 one.
+    """
+    print(u"Tone: {:} Hz, last 1 s of {:} s, {:} Hz".format(f, d, s))
+    print(u"{:<10}{:>16}{:>14}".format("dtype", "measured (Hz)", "error (Hz)"))
+    tails = {}
+    for dtype in (np.float32, np.float64):
+        tail = np.zeros(0)
+        for block in calibrate.tone_blocks(f, 1., d, s, dtype=dtype):
+            tail = np.concatenate([tail, block])[-int(s) - int(s * calibrate.RAMP_DUR):]
+        # Leave out the offset ramp
+        tails[dtype] = tail[:int(s)]
+        measured = tone_frequency(tails[dtype].astype(np.float64), s)
+        print(u"{:<10}{:>16.6f}{:>14.2e}".format(np.dtype(dtype).name, measured, measured - f))
+    diff = np.max(np.abs(tails[np.float32] - tails[np.float64]))
+    print(u"Largest float32 sample error: {:.2e} ({:.1f} dB re full scale)".format(diff, 20. * np.log10(diff)))
+
+    hp, lp = calibrate.band_edges(c, w)
+    print(u"Noise: {:.3g}-octave band at {:} Hz, {:} s".format(w, c, noise_d))
+    print(u"{:<14}{:<10}{:>12}{:>10}{:>12}{:>10}".format("engine", "dtype", "low (Hz)", "error", "high (Hz)", "error"))
+    for name, engine in calibrate.NOISE_ENGINES:
+        for dtype in (np.float32, np.float64):
+            signal = engine(c, w, .1, 0., noise_d, s, dtype=dtype)
+            # Short segments, so many are averaged and the slopes are smooth
+            lo, hi = calibrate.band_edges_3db(*calibrate.scipy_signal().welch(signal.astype(np.float64), s, nperseg=int(s) // 8), c=c)
+            print(u"{:<14}{:<10}{:>12.1f}{:>10.1f}{:>12.1f}{:>10.1f}".format(
+                name, np.dtype(dtype).name, lo, lo - hp, hi, hi - lp))
+
+
+def compare(old_file, results):
+    """Prints the ratio of each stage's wall time to the same stage in an earlier results file."""
+    with open(old_file) as fid:
+        old = json.load(fid)
+    def key(row):
+        return (row["stage"], row["duration"], row["rate"], row["bandwidth"])
+    old_rows = dict((key(row), row) for row in old["results"] if not row.get("skipped"))
+    print(u"Compared to {:} (revision {:}); ratio > 1 is slower".format(old_file, old["meta"].get("revision")))
+    for row in results:
+        prev = old_rows.get(key(row))
+        if prev is None or row.get("skipped"):
+            continue
+        print(u"{:<16}{:>9}{:>10}{:>7}{:>9.2f}x".format(row["stage"], row["duration"], row["rate"],
+              u"" if row["bandwidth"] is None else u"{:.2f}".format(row["bandwidth"]),
+              row["wall_s"] / max(prev["wall_s"], 1e-9)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for calibrate")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("noise", help="Compare the noise engines, and the filter bank")
+    commands.add_parser("import", help="Measure import times")
+    sub = commands.add_parser("suite", help="Time each stage of play() over a grid of parameters")
+    sub.add_argument("--full", action="store_true",
+                     help="Use the full grid (1 s to 30 min, 22.05 to 192 kHz)")
+    sub.add_argument("--durations", type=float, nargs="+", help="Durations, in s")
+    sub.add_argument("--rates", type=float, nargs="+", help="Sample rates, in Hz")
+    sub.add_argument("--bandwidths", type=float, nargs="+", help="Noise bandwidths, in octaves")
+    sub.add_argument("--stages", nargs="+", choices=[st[0] for st in STAGES], help="Stages to run")
+    sub.add_argument("--max-samples", type=int, default=2**26,
+                     help="Skip stages that render stimuli longer than this (default: 2**26)")
+    sub.add_argument("--json", help="Write the results to this file")
+    sub.add_argument("--compare", help="Compare against results written earlier with --json")
+    sub = commands.add_parser("precision", help="Check tone frequency and noise band edges in float32 and float64")
+    sub.add_argument("--duration", type=float, default=1800., help="Tone duration, in s (default: 1800)")
+    args = parser.parse_args(argv)
+
+    if args.command in [None, "noise"]:
+        bench_noise_engines()
+        bench_filter_bank()
+    if args.command in [None, "import"]:
+        bench_import()
+    if args.command is None:
+        bench_suite(**QUICK_GRID)
+    elif args.command == "suite":
+        grid = dict(FULL_GRID if args.full else QUICK_GRID)
+        for name in grid:
+            if getattr(args, name):
+                grid[name] = getattr(args, name)
+        results = bench_suite(stages=args.stages, max_samples=args.max_samples, json_file=args.json, **grid)
+        if args.compare:
+            compare(args.compare, results)
+    elif args.command == "precision":
+        bench_precision(d=args.duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -22,344 +22,1741 @@
 # cbrown1@pitt.edu.
 #
 
+import os
 import sys
 import time
-
-import asciimatics as am
-import asciimatics.widgets as am_widgets
-import asciimatics.scene as am_scene
-import asciimatics.screen as am_screen
-import asciimatics.exceptions as am_exceptions
-from asciimatics.event import KeyboardEvent
-from collections import defaultdict
+import struct
+import threading
+import fractions
+import contextlib
+import argparse
+import itertools
+import json
+import csv
+import concurrent.futures
+
+from collections import OrderedDict
 
 import numpy as np
-import scipy.signal
-import medussa as m
 #import psylab
 
 
-class get_input(am_widgets.Frame):
-    
-    """A generic full-screen menu form that can handle three types of menu options:
-        
-          - asciimatics frames: move back and forth between menu screens (am frames)
-          - functions: run arbitrary functions, with access to all available data
-          - variables: update variables, display their current state, specify 
-              defaults & (numeric) var types. Var types must be numeric (float, int, 
-              etc) at this point. This is because the interface is designed to make
-              navigation as efficient as possible, so that a single keypress is 
-              interpreted as a menu selection. Since letter keys are used for menus,
-              if letters were allowed to be used in updating variables, it would be 
-              impossible to know which was intended by the user. The usecase also 
-              required many numeric variables but no text, so this is not a problem. 
-
-
-    """
-    def __init__(self, screen):
-        super(get_input, self).__init__(screen,
-                                        screen.height,
-                                        screen.width,
-                                        title="Calibrate!")
-
-        self.number_keys = [ord('1'), ord('2'), ord('3'), ord('4'), ord('5'), ord('6'), ord('7'), ord('8'), ord('9'), ord('0'), ord('.') ]
-        layout1 = am_widgets.Layout([1], fill_frame=False)
-        layout2 = am_widgets.Layout([2,8], fill_frame=False)
-        layout3 = am_widgets.Layout([91,9], fill_frame=False)
-        self._nav = am_widgets.Label(self.nav)
-        self._hl = am_widgets.Divider()
-        self._blankline = am_widgets.Divider(height=1, draw_line=False)
-        self._psylab = am_widgets.Label(u"psylab")
-        # The listbox takes up 1 more line than is visible, because quit is added after
-        # the height is computed. So setting height to FILL_FRAME pushes the bottom line 
-        # of the visible screen. There are 9 additional lines on the screen other than
-        # the listbox, so subtract 9 from screen. 
-        list_height = self._screen.height - 9 
-        self._list = am_widgets.ListBox(
-            list_height,
-#            am_widgets.Widget.FILL_FRAME,
-            options=[],
-            on_change=self._on_change,
-            on_select=self._on_select,
-            name="list_main",
-            )
-        self.enter_key = u"\u21B2"
-        self.keys = []
-        n = 0
-        has_val = False
-        for val in self.options:
-            if len(val['desc']) > n:
-                n = len(val['desc'])
-            if val['type'] not in ["frame", "func"]:
-                has_val = True
-        fmt_key  = u"    {}{} :  "
-        fmt_desc = u"{{:{:}}}".format(n)
-        fmt_cur_ = u"   {}"
-        for val in self.options:
-            val["fmt_key"] = fmt_key
-            val["fmt_desc"] = fmt_desc.format(val["desc"])
-            if val.has_key("cur_str"):
-                val["fmt_cur"] = fmt_cur_.format(val["cur_str"])
-            else:
-                val["fmt_cur"] = ""
-            self.keys.append(ord(val["key"]))
-        if has_val:
-            expl = u"Option :  " + fmt_desc.format("Explanation") + u"   [value]"
-        else:
-            expl = u"Option :  Explanation"
-        self._explain = am_widgets.Label(expl)
-        self.instructions_no_opt = u"Choose an option"
-        self.instructions_opt = u"Choose an option or type value (blank=default), enter to update."
-        self._instructions = am_widgets.Label(self.instructions_no_opt)
-        self._input_label = am_widgets.Label("Enter a value: ")
-        self._input = am_widgets.Text(name="input")
-        self.add_layout(layout1)
-        self.add_layout(layout2)
-        self.add_layout(layout3)
-        layout1.add_widget(self._nav)
-        layout1.add_widget(self._hl)
-        layout1.add_widget(self._explain)
-        layout1.add_widget(self._blankline)
-        layout1.add_widget(self._list)
-        layout2.add_widget(self._input_label)
-        layout2.add_widget(self._input, column=1)
-        layout2.add_widget(self._blankline)
-        layout3.add_widget(self._instructions)
-        layout3.add_widget(self._psylab, column=1)
-        self.fix()
-        self._input.disabled = True
-        self._input_label.disabled = True
-        self.current_type = None
-#        self._list.value = 0
-#        self._list._on_select()
-
-        # Add my own colour palette
-        self.palette = defaultdict(
-            lambda: (am_screen.Screen.COLOUR_WHITE, am_screen.Screen.A_NORMAL, am_screen.Screen.COLOUR_BLACK))
-        for key in ["selected_focus_field", "label"]:
-            self.palette[key] = (am_screen.Screen.COLOUR_WHITE, am_screen.Screen.A_BOLD, am_screen.Screen.COLOUR_BLACK)
-        self.palette["title"] = (am_screen.Screen.COLOUR_BLACK, am_screen.Screen.A_BOLD, am_screen.Screen.COLOUR_WHITE)
-        self.palette["disabled"] = (am_screen.Screen.COLOUR_BLACK, am_screen.Screen.A_NORMAL, am_screen.Screen.COLOUR_BLACK)
-
-
-    def process_event(self, event):
-
-        unhandled = True
-        if isinstance(event, am.event.KeyboardEvent):
-
-
-            # self._scene.add_effect(
-            #    am_widgets.PopUpDialog(self._screen,
-            #                            "{:}".format(event.key_code),
-            #                            ["Cancel", "OK"],
-            #                            on_close=self._confirm_quit))
-            if event.key_code in self.keys:
-                self._list.value = self.keys.index(event.key_code)
-                self._list._on_select()
-                unhandled = False
-
-            elif event.key_code in [ord('q')]:
-                self._list.value = len(self.options)
-                self._list._on_select()
-                unhandled = False
-
-            elif self._list.value != None:
-                # self._scene.add_effect(
-                #   am_widgets.PopUpDialog(self._screen,
-                #                           "Value!",
-                #                           ["Cancel", "OK"],
-                #                           on_close=self._confirm_quit))
-                if self._list.value < len(self.options):
-                    # self._scene.add_effect(
-                    #   am_widgets.PopUpDialog(self._screen,
-                    #                           "Option!",
-                    #                           ["Cancel", "OK"],
-                    #                           on_close=self._confirm_quit))
-                    if self.options[self._list.value]["type"] not in ['frame', 'func']:
-                        # self._scene.add_effect(
-                        #   am_widgets.PopUpDialog(self._screen,
-                        #                           "Var!",
-                        #                           ["Cancel", "OK"],
-                        #                           on_close=self._confirm_quit))
-                        if event.key_code in [10]:
-                            # User hit enter. Update 
-                            if self._input.value == "":
-                                # Textbox has no value, update the selected var with default
-                                self.options[self._list.value]["val"] = self.options[self._list.value]["default"]
-                            else:
-                                # Textbox is not empty; Update the selected var with val from textbox
-                                self.options[self._list.value]["val"] = self.options[self._list.value]["type"](self._input.value)
-                            self._list._on_select()
-                            # Empty the textbox
-                            self._input.value = ""
-                            unhandled = False
-
-                        elif event.key_code in [-300]:
-                            # Backspace key; delete last character in textbox
-                            self._input.value = self._input.value[:-1]
-                            unhandled = False
-                        elif event.key_code in self.number_keys:
-                            self._input.value = self._input.value + chr(event.key_code)
-                            unhandled = False
-        
-        if unhandled:
-            # Pass unhandled events to lower levels for normal handling
-            return super(get_input, self).process_event(event)
-
-
-    def _on_select(self):
-
-        if self._list.value == len(self.options):
-            self._scene.add_effect(
-                am_widgets.PopUpDialog(self._screen,
-                                        "Really quit?",
-                                        ["No", "Yes"],
-                                        on_close=self._confirm_quit))
-
-        elif self.options[self._list.value]["type"] == "frame":
-            # Item is a frame; Go there
-            key = self.options[self._list.value]["key"]
-            frame = self.options[ self.keys.index(ord(key)) ] ["val"]
-            self.next_scene(frame)
-
-        elif self.options[self._list.value]["type"] == "func":
-            # Item is a function; Call it
-            ret = getattr(self, self.options[self._list.value]["val"])()
+# Stimuli are generated and played in blocks of this many frames
+BLOCK_SIZE = 4096
+# Number of blocks in the ring buffer that feeds a streamed stimulus
+RING_BLOCKS = 4
+# Duration of the onset and offset ramps, in s
+RAMP_DUR = .02
+# Duration of the noise token that is looped in continuous mode, in s
+LOOP_NOISE_DUR = 5.
+# Noise samples drawn from each independent random stream; see fill_randn()
+NOISE_CHUNK = 2**20
+# Frames written to a file at a time, through a memory map of that part of the file
+FILE_CHUNK = 2**20
+# Data type of generated signals; see set_dtype()
+DTYPE = np.float32
+# Where the calibration table is kept, unless --calibration says otherwise
+CALIBRATION_FILE = os.path.join(os.path.expanduser("~"), ".calibrate.npz")
+# Where the timings of each stimulus are logged; see set_timing_log()
+TIMING_LOG = os.path.join(os.path.expanduser("~"), ".calibrate_timings.jsonl")
+# The TCP port the control server listens on, unless --port says otherwise; see calibrate_server
+CONTROL_PORT = 7480
+# Center frequencies, in Hz, of the lowest and highest bands of the filter bank; see bank_sweep()
+BANK_LOW = 125.
+BANK_HIGH = 8000.
+# Level, relative to full scale, above which the soft limiter starts to act (-1 dBFS)
+LIMIT_KNEE = .891
+# Limits of the spectral self-test; see verify_stimulus()
+VERIFY_FREQUENCY_TOL = 1e-6     # Tone frequency, as a fraction of the frequency
+VERIFY_THD_MAX = -60.           # Tone total harmonic distortion, in dB
+VERIFY_EDGE_TOL = .01           # Noise band -3 dB edges, as a fraction of the edge frequency
+VERIFY_FLATNESS_TOL = 1.        # Noise in-band ripple (beyond that expected of the estimate), in dB
+VERIFY_RMS_TOL = .2             # Rms, in dB
+
+
+# scipy.signal and medussa (which initialises PortAudio) are slow to import, so
+# they are imported on first use, or in the background by prewarm()
+
+def scipy_signal():
+    # The first call is timed, since it can be slow if prewarm() hasn't finished
+    if "scipy.signal" not in sys.modules:
+        with timed("import"):
+            import scipy.signal
+    import scipy.signal
+    return scipy.signal
+
+
+def scipy_fft():
+    if "scipy.fft" not in sys.modules:
+        with timed("import"):
+            import scipy.fft
+    import scipy.fft
+    return scipy.fft
+
+
+_backend = None
+
+def medussa():
+    """Returns the audio backend: medussa, unless another one was set with use_backend()."""
+    if _backend is not None:
+        return _backend
+    if "medussa" not in sys.modules:
+        with timed("import"):
+            import medussa
+    import medussa
+    return medussa
+
+
+def use_backend(backend):
+    """Plays stimuli through backend instead of medussa, eg., a NullBackend. None restores medussa.
+
+        Devices already open are closed, since they belong to the old backend.
+    """
+    global _backend
+    device_pool.close_all()
+    _backend = backend
 
-        else:
-            # Re-populate the listbox to update the value that changed
-            self.populate_list()
-            # Force a redraw
-            self._screen.force_update()
-
-
-    def _on_change(self):
-
-        if self._list.value != None: 
-            if self._list.value < len(self.options):
-                if self.options[self._list.value]["type"] in ["func", "frame"]:
-                    self._instructions.text = self.instructions_no_opt
-                    self._input.disabled = True
-                    self._input_label.disabled = True
-                    self._input_label.custom_colour = self.palette['label']
-                    self._input.blur()
-                else:
-                    self._instructions.text = self.instructions_opt
-                    self._input.disabled = False
-                    self._input_label.disabled = False
-                    self._input_label.custom_colour = self.palette['disabled']
-                    self._input.focus()
-
-            elif self._list.value == len(self.options):
-                # Quit; update in case user cancels
-                self._instructions.text = self.instructions_no_opt
-                self._input.disabled = True
-                self._input_label.disabled = True
-                self._input_label.custom_colour = self.palette['label']
-                self._input.blur()
-
-        # Redraw
-        self._screen.force_update()
-
-
-    def populate_list(self):
-
-        # Get current value of the listbox
-        value = self._list.value
-        options_l = []
-        for i, val in enumerate(self.options):
-            if i == value and val["type"] not in ["func", "frame"]:
-                # This listbox item is the selected on; use special prompt (pound sign & enter char)
-                key = val["fmt_key"].format(u"#", self.enter_key)
+
+def prewarm():
+    """Imports the slow modules on a background thread, so the first stimulus doesn't wait for them.
+
+        Returns the thread.
+    """
+    def run():
+        for func in [scipy_signal, scipy_fft, medussa]:
+            try:
+                func()
+            except ImportError:
+                pass
+    thread = threading.Thread(target=run, name="prewarm")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def set_dtype(dtype):
+    """Sets the data type that signals are generated in: float32 (the default) or float64.
+
+        float32 halves the memory and bandwidth of long stimuli, and is what the
+        sound card gets anyway. Phase accumulation and filtering are done in
+        float64 a block at a time either way, so precision doesn't drift over
+        long stimuli. Cached stimuli are dropped, since they are the old type.
+    """
+    global DTYPE
+    DTYPE = np.dtype(dtype).type
+    stimulus_cache.clear()
+
+
+def new_seed():
+    """Returns a fresh random seed, short enough to type back in."""
+    return int(np.random.SeedSequence().generate_state(1)[0])
+
+
+def chunk_rng(seed, i):
+    """Returns the random generator for chunk i of the noise drawn with seed.
+
+        Each chunk has its own stream: the seed's PCG64 stream jumped ahead i
+        times (by about 2**127 draws each), so the streams of different chunks
+        never overlap.
+    """
+    return np.random.Generator(np.random.PCG64(seed).jumped(i))
+
+
+def fill_randn(out, seed, workers=None):
+    """Fills out, in place, with gaussian noise drawn with seed, and returns it.
+
+        out is split into chunks of NOISE_CHUNK samples, each drawn from its own
+        stream (see chunk_rng), so the chunks are drawn in parallel threads
+        (up to workers, default: one per core) and the noise is the same for a
+        given seed whatever the number of workers. out must be contiguous.
+    """
+    cancel = cancel_event()
+    def fill(i):
+        if cancel is not None and cancel.is_set():
+            raise Cancelled()
+        chunk_rng(seed, i).standard_normal(out=out[i*NOISE_CHUNK:(i+1)*NOISE_CHUNK], dtype=out.dtype)
+    chunks = (len(out) + NOISE_CHUNK - 1) // NOISE_CHUNK
+    if chunks > 1:
+        with concurrent.futures.ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            list(pool.map(fill, range(chunks)))
+    elif chunks:
+        fill(0)
+    return out
+
+
+def randn_blocks(n, seed, block_size=BLOCK_SIZE, dtype=None):
+    """Yields the n samples that fill_randn would draw with seed, block_size at a time.
+
+        If n is None, blocks are yielded forever.
+    """
+    dtype = dtype or DTYPE
+    rng, rng_chunk = None, None
+    for start in (itertools.count(0, block_size) if n is None else range(0, n, block_size)):
+        block = np.empty(block_size if n is None else min(block_size, n - start), dtype)
+        pos = 0
+        while pos < len(block):
+            i = (start + pos) // NOISE_CHUNK
+            if i != rng_chunk:
+                rng, rng_chunk = chunk_rng(seed, i), i
+            k = min(len(block) - pos, (i + 1) * NOISE_CHUNK - start - pos)
+            rng.standard_normal(out=block[pos:pos+k], dtype=dtype)
+            pos += k
+        yield block
+
+
+def rms(signal):
+    """Returns the root-mean-square of signal."""
+    return np.sqrt(np.mean(np.square(signal)))
+
+
+def dbfs(level):
+    """Returns a level (rms or peak) in dB relative to full scale (1.), down to -120 dB for silence."""
+    return 20. * np.log10(np.maximum(level, 1e-6))
+
+
+def block_levels(signal, block_size=BLOCK_SIZE):
+    """Returns the rms and the peak of each block of signal, as two arrays.
+
+        The whole blocks are measured together, as the rows of a 2-d view of
+        the signal, and a last, shorter block on its own.
+    """
+    n = len(signal) // block_size * block_size
+    rows = signal[:n].reshape(-1, block_size)
+    ms = np.einsum("ij,ij->i", rows, rows, dtype=np.float64) / block_size
+    peak = np.maximum(rows.max(axis=1), -rows.min(axis=1))
+    if n < len(signal):
+        tail = signal[n:]
+        ms = np.append(ms, np.dot(tail, tail) / float(len(tail)))
+        peak = np.append(peak, max(tail.max(), -tail.min()))
+    return np.sqrt(ms), peak
+
+
+def signal_peak(blocks):
+    """Returns the peak (largest absolute value) of a signal given as an iterable of blocks.
+
+        Each block is scanned FILE_CHUNK samples at a time, with no copies, so
+        a stream can be checked without ever holding all of it. Raises
+        ValueError if any sample is NaN or infinite.
+    """
+    peak = 0.
+    for block in blocks:
+        for i in range(0, len(block), FILE_CHUNK):
+            check_cancelled()
+            chunk = block[i:i+FILE_CHUNK]
+            # NaN carries through max and min, so this also catches it
+            high, low = chunk.max(), chunk.min()
+            if not (np.isfinite(high) and np.isfinite(low)):
+                raise ValueError("The signal has samples that are not finite numbers")
+            peak = max(peak, high, -low)
+    return float(peak)
+
+
+class SoftLimiter(object):
+    """Keeps the peaks of a signal below ceiling, bending them over smoothly.
+
+        Samples up to LIMIT_KNEE * ceiling pass unchanged. Larger ones are
+        compressed with a tanh curve that approaches ceiling, and never
+        exceeds it (even after rounding to float32). There is no state carried from one sample to the next, so
+        streamed signals can be limited a block at a time. limited counts the
+        samples changed so far.
+    """
+    def __init__(self, ceiling=1.):
+        self.ceiling = ceiling
+        self.limited = 0
+
+    def __call__(self, block):
+        """Limits block in place, and returns it."""
+        knee = LIMIT_KNEE * self.ceiling
+        if block.max() <= knee and -block.min() <= knee:
+            return block
+        idx = np.flatnonzero(np.abs(block) > knee)
+        over = block[idx]
+        span = self.ceiling - knee
+        limited = np.minimum(knee + span * np.tanh((np.abs(over) - knee) / span), self.ceiling * (1. - 1e-6))
+        block[idx] = np.copysign(limited, over)
+        self.limited += len(idx)
+        return block
+
+
+class LevelMeter(object):
+    """The rms and peak level of each block of a stimulus as it plays, in dBFS.
+
+        A BlockPlayer measures each block as it writes it to a slot of its
+        ring, after any live gain and limiting, and status() is given the slot
+        under the playback cursor, so the level shown is that of what is
+        being heard. Levels are scaled by gain, the largest gain of the
+        stream's mix matrix, so they are those of the loudest output channel.
+        max_peak is the highest peak so far, and clipped the number of
+        samples over full scale.
+    """
+    def __init__(self, n_slots, gain=1.):
+        self.gain = gain
+        self.rms = np.zeros(n_slots)
+        self.peak = np.zeros(n_slots)
+        self.max_peak = 0.
+        self.clipped = 0
+
+    def measure(self, slot, block):
+        rms_, peak = block_levels(block, len(block))
+        self.rms[slot] = rms_[0] * self.gain
+        self.peak[slot] = peak[0] * self.gain
+        if self.peak[slot] > self.max_peak:
+            self.max_peak = self.peak[slot]
+        if self.peak[slot] > 1.:
+            self.clipped += np.count_nonzero(np.abs(block) * self.gain > 1.)
+
+    def status(self, slot=None):
+        """Returns the levels of slot, or just the highest peak if slot is None, as text."""
+        text = u"max peak {:.1f} dBFS;".format(dbfs(self.max_peak))
+        if slot is not None:
+            text = u"Level {:.1f} dBFS rms, {:.1f} peak; ".format(dbfs(self.rms[slot]), dbfs(self.peak[slot])) + text
+        if self.clipped:
+            text += u" CLIPPED {:} samples;".format(self.clipped)
+        return text
+
+
+# The Timings being collected on each thread, if any
+_timing = threading.local()
+
+
+class Timings(object):
+    """How long each stage of starting a stimulus took, and the sizes of its buffers.
+
+        While a Timings is active (on the thread that made it active), code
+        on the path from the menu to the sound card times its stages with
+        timed() and notes its buffer sizes with note_size(). Elsewhere (eg.,
+        when a sweep renders steps in the background) those calls do nothing.
+        Time spent in a stage nested in another (eg., an import during
+        filtering) only counts towards the inner stage.
+    """
+    def __init__(self, kind=None, p=None):
+        self.kind = kind
+        self.params = p
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.sizes = OrderedDict()
+        self.prerendered = False
+        self.latency = None     # From playback being asked for until the stream started, in s
+        self.cancel = None      # An Event set to cancel opening the stimulus; see check_cancelled()
+        self.seeds = {}         # Noise seeds drawn, kept in last_seeds once the stimulus plays; see noise_seed()
+        self._nested = 0.       # Time spent in stages nested in the current one
+
+    @contextlib.contextmanager
+    def active(self):
+        previous = getattr(_timing, "current", None)
+        _timing.current = self
+        try:
+            yield self
+        finally:
+            _timing.current = previous
+
+    def record(self):
+        """Returns the timings as a dict, eg., to log as JSON."""
+        return OrderedDict([
+                            ("time", time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started))),
+                            ("kind", self.kind),
+                            ("stages_ms", OrderedDict((k, round(v * 1e3, 3)) for k, v in self.stages.items())),
+                            ("total_ms", round(sum(self.stages.values()) * 1e3, 3)),
+                            ("latency_ms", None if self.latency is None else round(self.latency * 1e3, 3)),
+                            ("prerendered", self.prerendered),
+                            ("sizes", self.sizes),
+                            ("params", self.params),
+                           ])
+
+    def summary(self):
+        """Returns the timings as one line of text."""
+        text = u"ms: " + u", ".join(u"{:} {:.1f}".format(k, v * 1e3) for k, v in self.stages.items())
+        if self.latency is not None:
+            text += u"; latency {:.1f}{:}".format(self.latency * 1e3, u" (prerendered)" if self.prerendered else u"")
+        if self.sizes:
+            text += u"; " + u", ".join(u"{:} {:.0f} kB".format(k, v / 1024.) for k, v in self.sizes.items())
+        return text
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """Times a stage of starting a stimulus, if the thread has an active Timings."""
+    timings = getattr(_timing, "current", None)
+    if timings is None:
+        yield
+        return
+    outer = timings._nested
+    timings._nested = 0.
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        timings.stages[stage] = timings.stages.get(stage, 0.) + elapsed - timings._nested
+        timings._nested = outer + elapsed
+
+
+class Cancelled(Exception):
+    """Raised when opening a stimulus is cancelled, eg., when a stimulus opened ahead of time is no longer wanted."""
+
+
+def cancel_event():
+    """Returns the Event that cancels the stimulus being opened on this thread, or None."""
+    timings = getattr(_timing, "current", None)
+    return None if timings is None else timings.cancel
+
+
+def check_cancelled():
+    """Raises Cancelled if the stimulus being opened on this thread has been cancelled.
+
+        Called between chunks of the work of opening a stimulus (drawing,
+        filtering, rendering, and checking the peak), so stale work stops
+        early rather than running to completion.
+    """
+    cancel = cancel_event()
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+
+
+def note_size(name, nbytes):
+    """Notes the size of a buffer, if the thread has an active Timings."""
+    timings = getattr(_timing, "current", None)
+    if timings is not None:
+        timings.sizes[name] = nbytes
+
+
+def set_timing_log(filename):
+    """Sets the file (JSON lines) that the timings of each stimulus are appended to; None to not log them.
+
+        A blank name also turns logging off, as does a pair of quotes, which
+        is what --timing-log '' passes through shells that don't remove them.
+    """
+    global TIMING_LOG
+    if filename is not None and not filename.strip().strip("'\"").strip():
+        filename = None
+    TIMING_LOG = filename
+
+
+def log_timings(timings):
+    if TIMING_LOG:
+        with open(TIMING_LOG, "a") as fid:
+            fid.write(json.dumps(timings.record(), default=str) + "\n")
+
+
+def hanning_ramp(s):
+    """Returns a hanning window whose first half is the onset ramp, and second half the offset ramp.
+    """
+    rdur = int(np.round(RAMP_DUR*s))
+    return np.hanning(2*rdur)
+
+
+def apply_ramps(block, start, total, ramp):
+    """Applies onset and offset ramps, in place, to one block of a longer signal.
+
+        block is the chunk of signal, start is the index of its first sample within
+        the whole signal, and total is the length of the whole signal (None if it
+        has no end). Pass start=0 and total=len(block) to ramp a whole signal.
+    """
+    rdur = len(ramp) // 2
+    end = start + len(block)
+    if start < rdur:
+        k = min(end, rdur)
+        block[:k-start] *= ramp[start:k]
+    if total is not None and end > total - rdur:
+        k = max(start, total - rdur)
+        block[k-start:] *= ramp[rdur+k-(total-rdur):rdur+end-(total-rdur)]
+    return block
+
+
+class LiveControl(object):
+    """Level and frequency adjustments to a stimulus while it plays.
+
+        gain_db and cents are nudged from the menu, and read by the threads
+        generating the stimulus: a BlockPlayer applies the gain to each block
+        as it writes it to the ring, and tone_blocks scales its frequency by
+        ratio. Both glide to their new value over a block, so nudges don't
+        click. They are heard once the blocks already in the ring have played.
+    """
+    def __init__(self):
+        self.gain_db = 0.
+        self.cents = 0.
+        self._gain = 1.         # The gain applied to the end of the last block
+        self._glide = None
+        self._buf = None
+
+    def nudge(self, db=0., cents=0.):
+        self.gain_db = round(self.gain_db + db, 6)
+        self.cents = round(self.cents + cents, 6)
+
+    @property
+    def gain(self):
+        return 10. ** (self.gain_db / 20.)
+
+    @property
+    def ratio(self):
+        return 2. ** (self.cents / 1200.)
+
+    def apply(self, block):
+        """Applies the gain to block in place, gliding from the gain at the end of the last block."""
+        gain = self.gain
+        if gain != self._gain:
+            if self._glide is None or len(self._glide) != len(block):
+                self._glide = np.arange(1, len(block)+1) / float(len(block))
+                self._buf = np.empty(len(block))
+            np.multiply(self._glide, gain - self._gain, out=self._buf)
+            self._buf += self._gain
+            block *= self._buf
+            self._gain = gain
+        elif gain != 1.:
+            block *= gain
+        return block
+
+    def adjusted(self, p):
+        """Returns the parameters in p that the adjustments change, with their new values."""
+        new = {}
+        if self.gain_db:
+            if p.get("spl"):
+                new["spl"] = round(p["spl"] + self.gain_db, 6)
+            elif "amplitude" in p:
+                new["amplitude"] = round(p["amplitude"] * self.gain, 6)
+            elif "attenuation" in p:
+                new["attenuation"] = round(p["attenuation"] - self.gain_db, 6)
+        if self.cents and "frequency" in p:
+            new["frequency"] = round(p["frequency"] * self.ratio, 3)
+        return new
+
+    def status(self):
+        return u"Live: {:+.1f} dB, {:+.0f} cents;".format(self.gain_db, self.cents)
+
+
+def tone_blocks(f, a, d, s, block_size=BLOCK_SIZE, dtype=None, control=None):
+    """Generates a ramped pure tone, one block at a time, in dtype (default: DTYPE).
+
+        The phase is carried from block to block (and wrapped to keep it
+        precise), so the blocks join seamlessly and memory use is set by
+        block_size rather than by the duration d. The phase is computed in
+        float64 whatever the dtype. If d is None, the tone has no end.
+
+        If control (a LiveControl) is given, the frequency is f * control.ratio,
+        read at each block; a change glides over the block, with no phase jump.
+    """
+    dtype = dtype or DTYPE
+    total = None if d is None else int(np.float32(d) * s)
+    ramp = hanning_ramp(s)
+    w0 = w = 2. * np.pi * f / s
+    phase = 0.
+    steps = np.arange(1, block_size+1)
+    if control is not None:
+        # The phase of a frequency that changes linearly over one block
+        glide = steps * (steps + 1) / (2. * block_size)
+    start = 0
+    while total is None or start < total:
+        k = block_size if total is None else min(block_size, total - start)
+        ph = phase + w * steps[:k]
+        if control is not None and w0 * control.ratio != w:
+            ph += (w0 * control.ratio - w) * glide[:k]
+            w = w0 * control.ratio
+        phase = ph[-1] % (2. * np.pi)
+        block = np.sin(ph, out=np.empty(k, dtype))
+        block *= a
+        yield apply_ramps(block, start, total, ramp)
+        start += k
+
+
+def loop_cycles(f, s):
+    """Returns the number of cycles, and of samples, in a seamless loop of a tone of frequency f.
+
+        The loop is at most 1 s long, so the frequency of the looped tone,
+        cycles * s / samples, can differ very slightly from f.
+    """
+    ratio = fractions.Fraction(f / float(s)).limit_denominator(int(s))
+    return ratio.numerator, ratio.denominator
+
+
+def tone_loop(f, a, s, dtype=None):
+    """Renders a tone buffer holding an integer number of cycles, so it can be looped seamlessly."""
+    cycles, n = loop_cycles(f, s)
+    return (a * np.sin(2. * np.pi * cycles * np.arange(1, n+1) / n)).astype(dtype or DTYPE)
+
+
+def loop_blocks(loop, s, block_size=BLOCK_SIZE):
+    """Yields blocks of a signal looped forever, with an onset ramp.
+
+        Stop the BlockPlayer playing it to end the signal with an offset ramp.
+    """
+    ramp = hanning_ramp(s)
+    steps = np.arange(block_size)
+    start = 0
+    while True:
+        block = loop[(start + steps) % len(loop)]
+        apply_ramps(block, start, None, ramp)
+        yield block
+        start += block_size
+
+
+def band_edges(c, w):
+    """Returns the lower and upper edges, in Hz, of a band w octaves wide centered on c."""
+    return c*(2.**(-w/2.)), c*(2.**(w/2.))
+
+
+def butter_noise(c, w, r, a, d, s, dtype=None, seed=None):
+    """Generates a noise band by filtering gaussian noise with 6th-order Butterworth filters.
+
+        The rms is set before filtering, so the level of the band depends on
+        its bandwidth. The noise is drawn with seed (default: a fresh one).
+    """
+    # Create noise
+    with timed("noise"):
+        signal = fill_randn(np.empty(np.int32(d*s), dtype or DTYPE), new_seed() if seed is None else seed)
+    # RMS
+    signal *= r / rms(signal)
+    # Atten
+    signal *= np.exp(np.float32(-a)/8.6860)
+
+    with timed("filter"):
+        return butter_filter(signal, c, w, s)
+
+
+def butter_filter(signal, c, w, s):
+    """Band-pass filters signal with a 6th-order Butterworth band-pass filter.
+
+        Returns a new array, of the same dtype as signal.
+    """
+    hp, lp = np.round(band_edges(c, w))
+    return BandFilter(butter_sos(6, hp, lp, s))(signal)
+
+
+_sos_designs = {}
+
+def butter_sos(order, hp, lp, s):
+    """Returns the second-order sections of a Butterworth band-pass filter from hp to lp.
+
+        Its response is 3 dB down at hp and lp, however narrow the band, and
+        its skirts fall at 6 * order dB/octave, like a high-pass and a low-pass
+        of that order. Designs are cached per (order, hp, lp, s), so don't
+        modify them.
+    """
+    key = (order, hp, lp, s)
+    sos = _sos_designs.get(key)
+    if sos is None:
+        sos = scipy_signal().butter(order, [hp/(s/2.), lp/(s/2.)], btype='band', output='sos')
+        _sos_designs[key] = sos
+    return sos
+
+
+class BandFilter(object):
+    """Filters a signal with second-order sections, one block at a time.
+
+        The filter state is carried from one block to the next, so filtering a
+        signal in blocks gives the same result as filtering it all at once.
+        The output has the dtype of the input, but the filtering itself is done
+        in float64 (BLOCK_SIZE samples at a time, whatever the length of the
+        block), since high-order sections need the precision.
+    """
+    def __init__(self, sos):
+        self.sos = sos
+        self.zi = np.zeros((sos.shape[0], 2))
+
+    def __call__(self, block):
+        out = np.empty_like(block)
+        for i in range(0, len(block), BLOCK_SIZE):
+            check_cancelled()
+            out[i:i+BLOCK_SIZE], self.zi = scipy_signal().sosfilt(self.sos, block[i:i+BLOCK_SIZE], zi=self.zi)
+        return out
+
+
+def butter_power(c, w, s):
+    """Returns the fraction of the power of white noise that butter_filter passes."""
+    hp, lp = np.round(band_edges(c, w))
+    _, h = scipy_signal().sosfreqz(butter_sos(6, hp, lp, s), worN=8192)
+    return np.mean(np.abs(h) ** 2)
+
+
+def butter_noise_blocks(c, w, r, a, d, s, block_size=BLOCK_SIZE, dtype=None, seed=None):
+    """Generates ramped Butterworth noise, as butter_noise does, one block at a time.
+
+        Memory use is set by block_size rather than by the duration d. The rms
+        is that of the noise before filtering, as for butter_noise, but is set
+        from its expected value rather than measured. The noise is drawn with
+        seed (default: a fresh one).
+    """
+    total = int(np.float32(d) * s)
+    hp, lp = np.round(band_edges(c, w))
+    filt = BandFilter(butter_sos(6, hp, lp, s))
+    ramp = hanning_ramp(s)
+    gain = r * np.exp(np.float32(-a)/8.6860)
+    noise = randn_blocks(total, new_seed() if seed is None else seed, block_size, dtype)
+    for start, block in zip(range(0, total, block_size), noise):
+        block *= gain
+        yield apply_ramps(filt(block), start, total, ramp)
+
+
+def fft_noise(c, w, r, a, d, s, circular=False, dtype=None, seed=None):
+    """Generates a noise band by shaping its spectrum directly.
+
+        Gaussian noise has independent gaussian real and imaginary parts in
+        every frequency bin, so only the bins inside the band are drawn, and a
+        single inverse FFT gives the signal. The band edges are exact and the
+        rms is set after shaping, so the level doesn't depend on bandwidth.
+
+        If circular is True, the noise is exactly periodic over its duration
+        (so it can be looped seamlessly). Otherwise the inverse FFT is computed
+        at a fast length and truncated. The spectrum and the signal are both
+        computed in dtype (default: DTYPE). The noise is drawn with seed
+        (default: a fresh one), and the inverse FFT uses every core.
+    """
+    dtype = dtype or DTYPE
+    n = int(np.float32(d) * s)
+    if circular:
+        nfft = n
+    else:
+        nfft = scipy_fft().next_fast_len(n, real=True)
+    # The bins from lo to hi are inside the band
+    hp, lp = band_edges(c, w)
+    lo = int(np.ceil(hp * nfft / s))
+    hi = min(int(np.floor(lp * nfft / s)), nfft // 2) + 1
+    if hi <= lo:
+        raise ValueError("There are no FFT bins from {:.1f} to {:.1f} Hz; make the band wider or longer, "
+                         "or keep it below {:} Hz".format(hp, lp, s / 2.))
+    spec = np.zeros(nfft // 2 + 1, dtype=np.result_type(dtype, np.complex64))
+    # The real and imaginary parts of the band, interleaved
+    with timed("noise"):
+        fill_randn(spec.view(spec.real.dtype)[2*lo:2*hi], new_seed() if seed is None else seed)
+    with timed("ifft"):
+        signal = scipy_fft().irfft(spec, nfft, workers=-1)[:n]
+    signal *= r / rms(signal)
+    signal *= np.exp(np.float32(-a)/8.6860)
+    return signal
+
+
+# Noise generators, indexed by the value of the noise "Filter" option
+NOISE_ENGINES = [
+                 ("Butterworth", butter_noise),
+                 ("FFT", fft_noise),
+                ]
+
+
+def octave_bands(w, low, high):
+    """Returns the center frequencies and edges, in Hz, of the fractional-octave bands from low to high.
+
+        The bands are w octaves wide, and their centers are 1000 Hz times
+        whole powers of 2**w (base 2, as for band_edges), so 1/3-octave bands
+        from 125 to 8000 Hz are the 19 standard ones. A w within .1% of a
+        whole fraction of an octave (eg. .333333) is taken as that fraction.
+        The bands are contiguous, so there is one more edge than centers.
+    """
+    b = np.round(1. / w)
+    if b >= 1 and abs(1. / w - b) < 1e-3 * b:
+        w = 1. / b
+    k = np.arange(np.ceil(np.log2(low / 1000.) / w - 1e-6), np.floor(np.log2(high / 1000.) / w + 1e-6) + 1)
+    if not len(k):
+        raise ValueError("There are no {:.3g}-octave bands from {:} to {:} Hz".format(w, low, high))
+    centers = 1000. * 2. ** (k * w)
+    return centers, np.append(centers * 2. ** (-w / 2.), centers[-1] * 2. ** (w / 2.))
+
+
+def filter_bank(signal, s, edges):
+    """Splits signal into contiguous frequency bands in one pass, and returns them as a bands by samples array.
+
+        The band between each pair of edges gets the FFT bins of signal from
+        the lower edge up to (but not including) the upper one, so the edges
+        are exact, and the bands add up to signal, band-limited to the outer
+        edges (with the FFT zero-padded to a fast length). A single forward FFT is shared by every band, and the inverse
+        FFTs are done in one call, across every core. The bands have the
+        dtype of signal (float32 or float64).
+    """
+    n = len(signal)
+    nfft = scipy_fft().next_fast_len(n, real=True)
+    with timed("filter"):
+        spec = scipy_fft().rfft(signal, nfft, workers=-1)
+        # The band of each bin, and the bins that are in a band
+        band = np.searchsorted(edges, np.arange(len(spec)) * (s / nfft), side="right") - 1
+        inside = np.flatnonzero((band >= 0) & (band < len(edges) - 1))
+        bank = np.zeros((len(edges) - 1, len(spec)), spec.dtype)
+        bank[band[inside], inside] = spec[inside]
+    with timed("ifft"):
+        return scipy_fft().irfft(bank, nfft, axis=-1, workers=-1)[:, :n]
+
+
+def noise_bank(edges, r, a, d, s, dtype=None, seed=None):
+    """Generates a noise band for each pair of edges, from a single draw of gaussian noise, with filter_bank.
+
+        As for fft_noise, the rms of each band is set to r after filtering,
+        so every band has the same level whatever its width. Each band is
+        ramped. Returns a bands by samples array, in dtype (default: DTYPE).
+        The noise is drawn with seed (default: a fresh one).
+    """
+    with timed("noise"):
+        signal = fill_randn(np.empty(int(np.float32(d) * s), dtype or DTYPE), new_seed() if seed is None else seed)
+    bank = filter_bank(signal, s, edges)
+    bank *= (r * np.exp(np.float32(-a)/8.6860) / bank_levels(bank)[0])[:, np.newaxis]
+    with timed("ramps"):
+        ramp = hanning_ramp(s)
+        for row in bank:
+            apply_ramps(row, 0, len(row), ramp)
+    return bank
+
+
+def bank_levels(bank):
+    """Returns the rms and the peak of each row of a bands by samples array."""
+    rms = np.sqrt(np.einsum("ij,ij->i", bank, bank, dtype=np.float64) / bank.shape[1])
+    return rms, np.maximum(bank.max(axis=1), -bank.min(axis=1))
+
+
+class FIRFilter(object):
+    """Filters a signal with a long FIR filter, one block at a time, by FFT convolution.
+
+        The tail of each convolution is carried into the next, so filtering a
+        signal in blocks gives the same result as filtering it all at once.
+        As with BandFilter, the output has the dtype of the input, and the
+        filtering is done in float64, BLOCK_SIZE samples at a time (so blocks
+        whose sizes are multiples of BLOCK_SIZE give exactly the same output).
+    """
+    def __init__(self, taps):
+        self.taps = taps
+        self._tail = np.zeros(len(taps) - 1)
+
+    def __call__(self, block):
+        out = np.empty_like(block)
+        for i in range(0, len(block), BLOCK_SIZE):
+            check_cancelled()
+            x = block[i:i+BLOCK_SIZE]
+            y = scipy_signal().fftconvolve(x.astype(np.float64), self.taps)
+            y[:len(self._tail)] += self._tail
+            out[i:i+len(x)] = y[:len(x)]
+            self._tail = y[len(x):]
+        return out
+
+
+def reblock(blocks, block_size=BLOCK_SIZE, skip=0):
+    """Yields the signal in blocks, leaving out its first skip samples, in blocks of block_size."""
+    buf = np.zeros(0)
+    for block in blocks:
+        if skip:
+            k = min(skip, len(block))
+            block, skip = block[k:], skip - k
+        buf = np.concatenate([buf, block]) if len(buf) else block
+        while len(buf) >= block_size:
+            yield buf[:block_size]
+            buf = buf[block_size:]
+    if len(buf):
+        yield buf
+
+
+# Pink noise has equal power in every octave above this frequency, in Hz, and is flat below it
+PINK_LOW = 20.
+# The long-term average speech spectrum: the standard speech spectrum level (in dB SPL/Hz) for
+# normal vocal effort in ANSI S3.5-1997, at 1/3-octave center frequencies from 160 to 8000 Hz
+SPEECH_SPECTRUM = (
+    [160., 200., 250., 315., 400., 500., 630., 800., 1000., 1250., 1600., 2000., 2500., 3150., 4000., 5000., 6300., 8000.],
+    [32.41, 34.48, 34.75, 33.98, 34.59, 34.27, 32.06, 28.30, 25.01, 23.00, 20.15, 17.32, 13.18, 11.55, 9.33, 5.31, 2.59, 1.13],
+)
+
+
+def pink_gain(f):
+    """Returns the amplitude response, across frequencies f, that turns white noise pink."""
+    return np.sqrt(PINK_LOW / np.maximum(f, PINK_LOW))
+
+
+def speech_gain(f):
+    """Returns the amplitude response, across frequencies f, that shapes white noise like speech (SPEECH_SPECTRUM).
+
+        The spectrum is interpolated in octaves, and continued beyond its ends
+        with the slope it has at each end.
+    """
+    x, level = np.log2(SPEECH_SPECTRUM[0]), np.array(SPEECH_SPECTRUM[1])
+    xf = np.log2(np.maximum(f, 1.))
+    db = np.interp(xf, x, level)
+    db += np.minimum(xf - x[0], 0.) * (level[1] - level[0]) / (x[1] - x[0])
+    db += np.maximum(xf - x[-1], 0.) * (level[-1] - level[-2]) / (x[-1] - x[-2])
+    return 10. ** ((db - level.max()) / 20.)
+
+
+_fir_designs = {}
+
+def shaping_taps(gain, s):
+    """Returns a linear-phase FIR filter with the amplitude response gain(f), scaled to pass the power of white noise unchanged.
+
+        The filter is about 0.2 s long, so its response is accurate down to
+        about 10 Hz. Designs are cached per (gain, s), so don't modify them.
+    """
+    key = (gain, s)
+    taps = _fir_designs.get(key)
+    if taps is None:
+        ntaps = 2 ** int(np.round(np.log2(s / 5.))) + 1
+        freqs = np.linspace(0., s / 2., 4097)
+        taps = scipy_signal().firwin2(ntaps, freqs, gain(freqs), fs=s)
+        taps /= np.sqrt(np.sum(taps ** 2))
+        _fir_designs[key] = taps
+    return taps
+
+
+def shaped_noise_blocks(gain, r, a, d, s, block_size=BLOCK_SIZE, dtype=None, seed=None):
+    """Generates ramped gaussian noise shaped by the amplitude response gain(f), one block at a time.
+
+        The noise is drawn with seed (default: a fresh one), and filtered by a
+        FIRFilter from shaping_taps. The filter is run for its length before
+        the noise starts, so the noise starts at full level. The rms, r, is
+        the expected rms of the shaped noise, before the attenuation a. If d
+        is None, the noise has no end.
+    """
+    taps = shaping_taps(gain, s)
+    total = None if d is None else int(np.float32(d) * s)
+    ramp = hanning_ramp(s)
+    level = r * np.exp(np.float32(-a)/8.6860)
+    filt = FIRFilter(taps)
+    noise = randn_blocks(None if total is None else total + len(taps) - 1,
+                         new_seed() if seed is None else seed, block_size, dtype)
+    start = 0
+    for block in reblock((filt(block) for block in noise), block_size, skip=len(taps) - 1):
+        block *= level
+        yield apply_ramps(block, start, total, ramp)
+        start += len(block)
+
+
+def warble_blocks(f, a, fm, dev, d, s, block_size=BLOCK_SIZE, dtype=None, control=None):
+    """Generates a ramped warble tone, one block at a time: a tone whose frequency swings sinusoidally fm times a second.
+
+        The frequency swings by dev (a fraction, eg., .05 for 5%) either side
+        of f. As in tone_blocks, the phase is carried from block to block in
+        float64, and if d is None, the tone has no end. If control (a
+        LiveControl) is given, the frequency is scaled by control.ratio,
+        read at each block.
+    """
+    dtype = dtype or DTYPE
+    total = None if d is None else int(np.float32(d) * s)
+    ramp = hanning_ramp(s)
+    w = 2. * np.pi * f / s
+    wm = 2. * np.pi * fm / s
+    phase = mphase = 0.
+    steps = np.arange(1, block_size+1)
+    start = 0
+    while total is None or start < total:
+        k = block_size if total is None else min(block_size, total - start)
+        ratio = 1. if control is None else control.ratio
+        mph = mphase + wm * steps[:k]
+        ph = phase + np.cumsum(w * ratio * (1. + dev * np.sin(mph - wm)))
+        phase = ph[-1] % (2. * np.pi)
+        mphase = mph[-1] % (2. * np.pi)
+        block = np.sin(ph, out=np.empty(k, dtype))
+        block *= a
+        yield apply_ramps(block, start, total, ramp)
+        start += k
+
+
+def click_blocks(a, rate, width, polarity, d, s, block_size=BLOCK_SIZE, dtype=None):
+    """Generates a train of rectangular clicks, rate a second, one block at a time.
+
+        Each click is width s long (at least one sample), with amplitude a.
+        polarity is 0 for positive clicks, 1 for negative ones, and 2 to
+        alternate, starting positive. There are no ramps, so the first click
+        is at full level. If d is None, the train has no end.
+    """
+    dtype = dtype or DTYPE
+    total = None if d is None else int(np.float32(d) * s)
+    period = s / float(rate)
+    n = max(1, int(np.round(width * s)))
+    start = 0
+    while total is None or start < total:
+        k = block_size if total is None else min(block_size, total - start)
+        block = np.zeros(k, dtype)
+        # The clicks that overlap this block
+        idx = np.arange(max(0, int(np.floor((start - n) / period))), int(np.ceil((start + k) / period)) + 1)
+        onsets = np.round(idx * period).astype(int) - start
+        sign = np.ones(len(idx)) if polarity == 0 else -np.ones(len(idx)) if polarity == 1 else 1. - 2. * (idx % 2)
+        for j in range(n):
+            pos = onsets + j
+            inside = (pos >= 0) & (pos < k)
+            block[pos[inside]] = a * sign[inside]
+        yield block
+        start += k
+
+
+def close_handle(obj):
+    """Stops and closes a medussa stream or device, if it knows how."""
+    for method in ["stop", "close"]:
+        func = getattr(obj, method, None)
+        if func is not None:
+            try:
+                func()
+            except Exception:
+                pass
+
+
+class DevicePool(object):
+    """Keeps medussa devices open between stimuli, instead of opening one per stimulus.
+
+        Devices are keyed by (device id, number of channels, sample rate). At most
+        max_devices are kept open, and the least recently used one is closed to make
+        room for a new one. Players opened on a device are tracked with track(), and
+        their streams closed once they are done (finished, or discarded unplayed).
+    """
+    def __init__(self, max_devices=2):
+        self.max_devices = max_devices
+        self._devices = OrderedDict()   # key -> device, least recently used first
+        self._players = {}              # key -> list of players opened on the device
+        self._lock = threading.Lock()
+
+    def get(self, i, n, s):
+        """Returns an open device for (device id, number of channels, sample rate)."""
+        key = (i, n, s)
+        with self._lock:
+            self._prune()
+            if key in self._devices:
+                # Move to the end, as the most recently used
+                self._devices[key] = self._devices.pop(key)
             else:
-                # This listbox item is not the selected on; use normal prompt (a char)
-                key = val["fmt_key"].format(val['key'], u" ")
-            # fmt_desc is already expanded since it doesn't change
-            desc = val["fmt_desc"]
-            if val.has_key("val"):
-                cur_val = val["fmt_cur"].format(unicode(val["val"]))
+                while self._devices and len(self._devices) >= self.max_devices:
+                    self._close(next(iter(self._devices)))
+                self._devices[key] = medussa().open_device(i, i, n)
+                self._players[key] = []
+            return self._devices[key]
+
+    def track(self, key, player):
+        """Registers a player opened on the device for key, so its stream can be closed later."""
+        with self._lock:
+            self._players.setdefault(key, []).append(player)
+
+    def evict(self, keep=None):
+        """Closes every device except the one for keep, and all of their streams.
+
+            Players still playing on them are stopped, without a fade.
+        """
+        with self._lock:
+            for key in list(self._devices):
+                if key != keep:
+                    self._close(key)
+
+    def close_all(self):
+        self.evict()
+
+    def counts(self):
+        """Returns the number of open devices and open streams."""
+        with self._lock:
+            self._prune()
+            return len(self._devices), sum(len(v) for v in self._players.values())
+
+    def status(self):
+        return u"Open devices: {:}, streams: {:}".format(*self.counts())
+
+    def _prune(self):
+        # Close the streams of players that are done. Players opened ahead of
+        # time (see Prerenderer) aren't playing yet, but aren't done either
+        for key, players in self._players.items():
+            for player in [pl for pl in players if pl.done.is_set()]:
+                close_handle(player.stream)
+                players.remove(player)
+
+    def _close(self, key):
+        for player in self._players.pop(key, []):
+            if not player.done.is_set():
+                # Stop it first, or its feeder thread waits forever on a stream that no longer moves
+                if player.is_playing:
+                    player.stop(fade=False)
+                    player.wait(1.)
+                else:
+                    player.discard()
+            close_handle(player.stream)
+        close_handle(self._devices.pop(key))
+
+
+# Shared by all of the menu screens
+device_pool = DevicePool()
+
+
+class NullBackend(object):
+    """A stand-in for medussa that plays nothing, for benchmarks and machines without audio hardware.
+
+        It provides the parts of medussa's device and array stream interface
+        that calibrate uses. Streams advance their cursor in real time once
+        played, so playback takes as long as it would on a real device.
+    """
+    def open_device(self, out_id=None, in_id=None, out_channels=None):
+        return _NullDevice(out_channels or 2)
+
+
+class _NullDevice(object):
+    def __init__(self, out_channels):
+        self.out_channels = out_channels
+
+    def open_array(self, arr, fs):
+        return _NullStream(arr, fs, self.out_channels)
+
+
+class _NullStream(object):
+    def __init__(self, arr, fs, out_channels):
+        self.arr = np.ascontiguousarray(arr)
+        if self.arr.ndim == 1:
+            self.arr = self.arr.reshape(-1, 1)
+        self.fs = fs
+        self.mix_mat = np.zeros((out_channels, self.arr.shape[1]))
+        self._looping = False
+        self._started = None
+
+    def loop(self, state=None):
+        if state is None:
+            return self._looping
+        self._looping = state
+
+    def play(self):
+        self._started = time.time()
+
+    def stop(self):
+        self._started = None
+
+    def _elapsed(self):
+        if self._started is None:
+            return 0
+        return int((time.time() - self._started) * self.fs)
+
+    @property
+    def cursor(self):
+        if self._looping:
+            return self._elapsed() % len(self.arr)
+        return min(self._elapsed(), len(self.arr))
+
+    @property
+    def is_playing(self):
+        return self._started is not None and (self._looping or self._elapsed() < len(self.arr))
+
+
+class StimulusCache(object):
+    """A least-recently-used cache of rendered stimuli, bounded by their total size in bytes.
+
+        Stimuli are keyed by a tuple of every parameter that affects them. A single
+        stimulus larger than max_bytes/4 is never cached; such stimuli are better
+        streamed than rendered. Cached arrays are read-only, since they are shared.
+    """
+    def __init__(self, max_bytes=256*2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()     # key -> signal, least recently used first
+        self._lock = threading.Lock()
+
+    def fits(self, nbytes):
+        """Returns True if a stimulus of nbytes is small enough to be cached."""
+        return nbytes <= self.max_bytes // 4
+
+    def get(self, key):
+        """Returns the stimulus for key, or None if it isn't cached."""
+        with self._lock:
+            signal = self._items.pop(key, None)
+            if signal is None:
+                self.misses += 1
             else:
-                cur_val = ""
-            options_l.append((key + desc + cur_val, len(options_l)))
+                self.hits += 1
+                self._items[key] = signal
+            return signal
+
+    def put(self, key, signal):
+        """Stores a stimulus, evicting the least recently used ones to make room."""
+        if not self.fits(signal.nbytes):
+            return
+        signal.flags.writeable = False
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            while self._items and self.nbytes + signal.nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+            self._items[key] = signal
+            self.nbytes += signal.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def status(self):
+        return u"Cache: {:} stimuli, {:.1f} MB, {:} hits, {:} misses".format(
+            len(self._items), self.nbytes / 2.**20, self.hits, self.misses)
+
+
+# Shared by all of the menu screens
+stimulus_cache = StimulusCache()
+
+
+def array_blocks(signal, block_size=BLOCK_SIZE):
+    """Yields a rendered signal one block at a time, eg., to play it with a BlockPlayer."""
+    for start in range(0, len(signal), block_size):
+        yield signal[start:start+block_size]
+
+
+class BlockPlayer(object):
+    """Plays a stream of signal blocks through a medussa device, in the background.
+
+        medussa plays numpy arrays, so a short ring buffer is opened as a looping
+        array stream, and a feeder thread refills each slot of the ring once the
+        playback cursor has moved past it. Memory use is set by the size of the
+        ring, not by the duration of the stimulus.
+
+        play() returns immediately. stop() ends the stimulus with an offset ramp a
+        block from the current position (which is how signals with no end, eg.,
+        loop_blocks, are ended). The done event is set when the stimulus has
+        finished or been stopped, and any functions passed to add_done_callback
+        are then called (from the feeder thread) with the player as argument.
+        total is the expected length of the signal in samples, if known, and is
+        only used to report progress. If control (a LiveControl) is given, its
+        gain is applied to each block as it is written to the ring, and then
+        limiter (a SoftLimiter), if given. Each block is then measured by
+        meter (a LevelMeter); gain is the largest gain the stream's mix
+        matrix applies, for the meter.
+    """
+    def __init__(self, dev, blocks, s, total=None, block_size=BLOCK_SIZE, n_blocks=RING_BLOCKS, control=None,
+                 limiter=None, gain=1.):
+        self.s = s
+        self.total = total
+        self.control = control
+        self.limiter = limiter
+        self.meter = LevelMeter(n_blocks, gain)
+        self.block_size = block_size
+        self.played = 0         # Samples played so far
+        self.done = threading.Event()
+        self._callbacks = []
+        self._blocks = iter(blocks)
+        self.timings = Timings()
+        with timed("open_array"):
+            self.stream = dev.open_array(np.zeros(block_size*n_blocks), s)
+            self.stream.loop(True)
+        note_size("ring", block_size * n_blocks * 8)
+        # Write into the array medussa is reading from, in case it made a copy
+        self._ring = self.stream.arr.reshape(-1)
+        self._written = 0       # Samples written to the ring so far
+        self._end = None        # Length of the signal, once the blocks run out
+        self._last_cursor = 0
+        self._wraps = 0
+        self._ramp = hanning_ramp(s)
+        self._fade = threading.Event()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._feed)
+        self._thread.daemon = True
+
+    def _fill(self):
+        # Write the next block into the next slot of the ring
+        pos = self._written % len(self._ring)
+        slot = self._ring[pos:pos+self.block_size]
+        block = None
+        if self._end is None:
+            block = next(self._blocks, None)
+        if block is None:
+            if self._end is None:
+                self._end = self._written
+            slot[:] = 0
+        else:
+            slot[:len(block)] = block
+            slot[len(block):] = 0
+            if self.control is not None:
+                self.control.apply(slot)
+            if self.limiter is not None:
+                self.limiter(slot[:len(block)])
+            if len(block) < self.block_size:
+                self._end = self._written + len(block)
+        self.meter.measure(pos // self.block_size, slot)
+        self._written += self.block_size
+
+    def _position(self):
+        # The number of samples played so far, counting the times the ring wrapped
+        cursor = self.stream.cursor
+        if cursor < self._last_cursor:
+            self._wraps += 1
+        self._last_cursor = cursor
+        return self._wraps * len(self._ring) + cursor
+
+    def _fade_out(self):
+        # Apply the offset ramp to the samples already in the ring, a block
+        # ahead of the cursor, and silence everything after it
+        rdur = len(self._ramp) // 2
+        start = self.played + self.block_size
+        if self._end is not None and self._end <= start + rdur:
+            return
+        idx = np.arange(start, self._written) % len(self._ring)
+        self._ring[idx[:rdur]] *= self._ramp[rdur:rdur+len(idx[:rdur])]
+        self._ring[idx[rdur:]] = 0
+        self._end = start + min(rdur, len(idx))
+
+    def _feed(self):
+        ring_len = len(self._ring)
+        interval = self.block_size / (4. * self.s)
+        while not self._stop.is_set():
+            self.played = self._position()
+            if self._fade.is_set():
+                self._fade.clear()
+                self._fade_out()
+            if self._end is not None and self.played >= self._end:
+                break
+            while self._written + self.block_size - ring_len <= self.played:
+                self._fill()
+            wait = interval
+            if self._end is not None:
+                # Wake up right when the last sample has played
+                wait = min(wait, (self._end - self.played) / float(self.s))
+            self._stop.wait(wait)
+        self.stream.stop()
+        with self._lock:
+            self.done.set()
+            callbacks = list(self._callbacks)
+        for func in callbacks:
+            func(self)
+
+    def add_done_callback(self, func):
+        """Calls func(player) when playback ends, or right away if it already has."""
+        with self._lock:
+            if not self.done.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def play(self, requested=None):
+        """Starts playback. requested is the time.perf_counter() at which it was asked for, if known.
+
+            The time from then until the stream starts is kept as the latency in
+            the player's timings.
+        """
+        with self.timings.active():
+            # Prime the whole ring before starting the stream
+            with timed("prime"):
+                while self._written < len(self._ring):
+                    self._fill()
+            with timed("stream_play"):
+                self.stream.play()
+        if requested is not None:
+            self.timings.latency = time.perf_counter() - requested
+        # Only a token that is heard can be frozen, not one opened ahead of time and discarded
+        last_seeds.update(self.timings.seeds)
+        self._thread.start()
+        log_timings(self.timings)
+
+    def discard(self):
+        """Marks a player that won't be played as done, so the device pool closes its stream."""
+        self.done.set()
+
+    def stop(self, fade=True):
+        """Stops playback, with an offset ramp unless fade is False."""
+        if fade:
+            self._fade.set()
+        else:
+            self._stop.set()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    @property
+    def is_playing(self):
+        return self._thread.is_alive()
+
+    def progress(self):
+        """Returns a short text description of how far playback has got."""
+        return progress_text(self.played, self.total, self.s)
+
+    def levels(self):
+        """Returns the level of the block playing, and the highest peak so far, as text."""
+        if self.done.is_set():
+            return self.meter.status()
+        return self.meter.status((self.played % len(self._ring)) // self.block_size)
+
+
+def progress_text(done, total, s):
+    """Returns the time done, and a progress bar if the total (in samples) is known, as text."""
+    t = done / float(s)
+    if not total:
+        return u"{:.1f} s".format(t)
+    frac = min(1., done / float(total))
+    bar = int(round(20 * frac))
+    return u"{:.1f} / {:.1f} s [{:}{:}]".format(t, total / float(s), u"#" * bar, u"-" * (20 - bar))
+
+
+def wav_header(n, s, frames):
+    """Returns the header of a WAV file of frames x n 32-bit float samples."""
+    data = frames * n * 4
+    fmt = struct.pack("<HHIIHH", 3, n, int(s), int(s) * n * 4, n * 4, 32)
+    # Files of float samples should have a fact chunk, holding the number of frames
+    fact = struct.pack("<I", frames)
+    size = 4 + (8 + len(fmt)) + (8 + len(fact)) + (8 + data)
+    if size >= 2**32:
+        raise ValueError("The stimulus is too long for a WAV file; write it to a .npy file instead")
+    return (b"RIFF" + struct.pack("<I", size) + b"WAVE" +
+            b"fmt " + struct.pack("<I", len(fmt)) + fmt +
+            b"fact" + struct.pack("<I", len(fact)) + fact +
+            b"data" + struct.pack("<I", data))
+
+
+def create_output_file(filename, n, s, frames):
+    """Creates a .wav or .npy file for frames x n 32-bit float samples, and returns the offset of the samples in it.
+
+        The samples are left as zeros, to be written through a memory map.
+    """
+    if filename.lower().endswith(".npy"):
+        np.lib.format.open_memmap(filename, mode="w+", dtype=np.float32, shape=(frames, n))
+        return os.path.getsize(filename) - frames * n * 4
+    if filename.lower().endswith(".wav"):
+        header = wav_header(n, s, frames)
+        with open(filename, "wb") as fid:
+            fid.write(header)
+            fid.truncate(len(header) + frames * n * 4)
+        return len(header)
+    raise ValueError("Stimuli can only be written to .wav or .npy files")
+
+
+class FileWriter(object):
+    """Writes a stream of signal blocks to a .wav or .npy file, in the background.
+
+        The file has one column per channel, and each block is mixed into the
+        columns with the gains in mix, as a device's mix matrix would. It is
+        written FILE_CHUNK frames at a time through a memory map of that part of
+        the file, so the stimulus never has to fit in memory. Samples are 32-bit
+        float. total is the length of the stimulus in samples.
+
+        A FileWriter runs like a BlockPlayer: play() returns immediately, and
+        stop(), wait(), done, add_done_callback() and progress() work the same
+        way. A stopped file is left silent from where writing stopped.
+    """
+    # Files can't be adjusted live, and aren't timed
+    control = None
+    timings = None
+
+    def __init__(self, filename, blocks, s, total, mix):
+        self.filename = filename
+        self.s = s
+        self.total = total
+        self.written = 0        # Frames written so far
+        self.peak = 0.          # The peak written so far, on the loudest channel
+        self.error = None
+        self.done = threading.Event()
+        self._blocks = iter(blocks)
+        self._mix = np.asarray(mix, dtype=np.float32)
+        self._offset = create_output_file(filename, len(self._mix), s, total)
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._write)
+        self._thread.daemon = True
+
+    def _map(self, start):
+        # Map the chunk of the file starting at frame start
+        n = len(self._mix)
+        return np.memmap(self.filename, dtype=np.float32, mode="r+", offset=self._offset + start * n * 4,
+                         shape=(min(FILE_CHUNK, self.total - start), n))
+
+    def _write(self):
+        chunk = None
+        start = 0
+        try:
+            for block in self._blocks:
+                if self._stop.is_set():
+                    break
+                block = block[:self.total - self.written]
+                if len(block):
+                    self.peak = max(self.peak, block.max(), -block.min())
+                k0 = 0
+                while k0 < len(block):
+                    if chunk is None or self.written == start + len(chunk):
+                        if chunk is not None:
+                            chunk.flush()
+                        start = self.written
+                        chunk = self._map(start)
+                    k = min(len(block) - k0, start + len(chunk) - self.written)
+                    np.multiply(block[k0:k0+k, None], self._mix, out=chunk[self.written-start:self.written-start+k])
+                    k0 += k
+                    self.written += k
+        except EnvironmentError as e:
+            self.error = e
+        finally:
+            if chunk is not None:
+                chunk.flush()
+                del chunk
+        with self._lock:
+            self.done.set()
+            callbacks = list(self._callbacks)
+        for func in callbacks:
+            func(self)
+
+    def add_done_callback(self, func):
+        """Calls func(writer) when writing ends, or right away if it already has."""
+        with self._lock:
+            if not self.done.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def play(self, requested=None):
+        # requested is only used by BlockPlayer
+        self._thread.start()
+
+    def stop(self, fade=True):
+        self._stop.set()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    @property
+    def is_playing(self):
+        return self._thread.is_alive()
+
+    def progress(self):
+        """Returns a short text description of how far writing has got."""
+        return progress_text(self.written, self.total, self.s)
+
+    def levels(self):
+        """Returns the highest peak written so far, as text."""
+        return u"max peak {:.1f} dBFS;".format(dbfs(self.peak * np.abs(self._mix).max()))
+
+    def summary(self):
+        if self.error is not None:
+            return u"Error writing {:}: {:}".format(self.filename, self.error)
+        if self.written < self.total:
+            return u"Stopped writing {:} at {:.1f} s".format(self.filename, self.written / float(self.s))
+        return u"Wrote {:} ({:.1f} s, {:} channels)".format(self.filename, self.total / float(self.s), len(self._mix))
+
+
+
+
+class NumberList(tuple):
+    """A tuple of numbers, entered and displayed as a comma-separated list, eg. 1,2
+
+        Used as an option type for options that take one or more values. It
+        accepts a string, a single number, or a sequence of numbers.
+    """
+    item_type = float
 
-        # Add quit to the list
-        key = val["fmt_key"].format("q", u" ")
+    def __new__(cls, value):
+        if isinstance(value, str):
+            value = [v for v in value.split(",") if v.strip()]
+        elif not isinstance(value, (list, tuple)):
+            value = [value]
+        return super(NumberList, cls).__new__(cls, [cls.item_type(v) for v in value])
 
-        options_l.append((key+"Quit", len(options_l)))
+    def __str__(self):
+        return u",".join(str(v) for v in self)
 
-        # Assign the newly created options to the listbox
-        self._list.options = options_l
-        # Select the previously selected option
-        self._list.value = value
+    __repr__ = __str__
 
 
-    def _update(self, frame_no):
+class ChannelList(NumberList):
+    item_type = int
 
-        if self._list.value < len(self.options):
-            self.populate_list()
 
-#        elif value == len(self.options):
-#            self._scene.add_effect(
-#                am_widgets.PopUpDialog(self._screen,
-#                            "Really quit?",
-#                            ["No", "Yes"],
-#                            on_close=self._confirm_quit))
+def channel_gains(outputs, gains):
+    """Returns one gain per output channel, given one gain for all of them or one per channel."""
+    if len(gains) == 1:
+        gains = list(gains) * len(outputs)
+    if len(gains) != len(outputs):
+        raise ValueError("Give one channel gain, or one per output channel")
+    return list(gains)
 
-        super(get_input, self)._update(frame_no)
 
-    @staticmethod
-    def _confirm_quit(selected):
-        # Yes is the second button
-        if selected == 1:
-            raise am_exceptions.StopApplication("User requested exit")
+def mix_gains(n, outputs, gains):
+    """Returns the gain of each of n channels, for a mono signal sent to outputs with gains.
 
-    @staticmethod
-    def next_scene(frame):
-        raise am_exceptions.NextScene(frame)
+        outputs are channel numbers (from 1), and gains are linear, one for all
+        outputs or one per output.
+    """
+    mix = np.zeros(n)
+    for o, g in zip(outputs, channel_gains(outputs, gains)):
+        if not 1 <= o <= n:
+            raise ValueError("Output channel {:} is not one of the {:} channels".format(o, n))
+        mix[o-1] = g
+    return mix
 
 
-class Frame_Main(get_input):
+def route(stream, n, outputs, gains):
+    """Sets the mix matrix of a stream playing a mono signal, to send it to several output channels.
 
-    nav = "Main"
-    options = [
-               {"key": "t", 
-                "desc": "Use pure tones",
-                "type": "frame",
-                "val": "Frame_Tone",
-               },
-               {"key": "n", 
-                "desc": "Use noise", 
-                "type": "frame",
-                "val": "Frame_Noise",
-               },
-              ]
+        See mix_gains for outputs and gains. The signal itself stays mono, so
+        memory use doesn't grow with the number of channels.
+    """
+    mm = stream.mix_mat
+    mm[:] = mix_gains(n, outputs, gains).reshape(mm.shape)
+    stream.mix_mat = mm
 
 
-class Frame_Tone(get_input):
-    nav = "Main / Tone"
-    options = [
-               {"key": "f",            # The key to press to select this option
-                "desc": "Frequency",   # A description of this option
-                "type": float,         # The type of menu item this is; frame, func, or a var type
-                "val": 1000.,          # If frame or func, the name; if var type, holds the value
-                "cur_str": "[{:} Hz]", # A format string to display the current value (var only)
-                "default": 1000.,      # A default value, applied when no value is entered (var only)
-               },
-               {"key": "a", 
-                "desc": "Amplitude",
-                "val": 1.,
-                "cur_str": "[{:} v]",  
-                "default": 1.,
-                "type": float,
-               },
-               {"key": "d", 
-                "desc": "Duration",
-                "val": 10.,
-                "cur_str": "[{:} s]", 
-                "default": 10.,
-                "type": float,
-               },
+def output_gain(p):
+    """Returns the largest gain of the output channels in p, which sets the level of the loudest one."""
+    return max(abs(g) for g in channel_gains(p["output"], p["gains"]))
+
+
+def output_limiter(p):
+    """Returns a SoftLimiter that keeps every output channel in p below full scale, or None if p["limit"] is off."""
+    gain = output_gain(p)
+    if p.get("limit") and gain:
+        return SoftLimiter(1. / gain)
+    return None
+
+
+def peak_text(peak, p):
+    """Returns the peak of a stimulus, on its loudest output channel, as text, with a warning if it would clip."""
+    level = peak * output_gain(p)
+    text = u" peak {:.1f} dBFS;".format(dbfs(level))
+    if p.get("limit") and level > LIMIT_KNEE:
+        text += u" limited;"
+    elif level > 1.:
+        text += u" WILL CLIP;"
+    return text
+
+
+class CalibrationTable(object):
+    """The measured sensitivity of each output channel of each device, in dB SPL for 1 V rms, across frequency.
+
+        The table is kept in a compressed .npz file, with one array per device
+        and channel, named d<device>c<channel>. Each array has two rows: the
+        frequencies measured, in Hz, and the sensitivities. Between measured
+        frequencies, sensitivities are interpolated on a log frequency axis.
+        Beyond the ends, they are held at the nearest measurement.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.curves = {}
+        if filename is not None and os.path.exists(filename):
+            with np.load(filename) as data:
+                for name in data.files:
+                    device, channel = name[1:].split("c")
+                    self.curves[(int(device), int(channel))] = data[name]
+
+    def save(self, filename=None):
+        np.savez_compressed(filename or self.filename,
+                            **dict(("d{:}c{:}".format(*key), curve) for key, curve in self.curves.items()))
+
+    def record(self, device, channel, frequency, sensitivity):
+        """Sets the sensitivity of a channel at a frequency, replacing any measured there before."""
+        curve = self.curves.get((device, channel), np.zeros((2, 0)))
+        curve = np.hstack([curve[:, curve[0] != frequency], [[frequency], [sensitivity]]])
+        self.curves[(device, channel)] = curve[:, np.argsort(curve[0])]
+
+    def sensitivity(self, device, channels, frequencies):
+        """Returns the sensitivity of each of channels at each of frequencies, one row per channel.
+
+            Raises ValueError if a channel has not been calibrated.
+        """
+        logf = np.log2(frequencies)
+        sens = np.empty((len(channels), len(logf)))
+        for row, channel in enumerate(channels):
+            curve = self.curves.get((device, channel))
+            if curve is None:
+                raise ValueError("Channel {:} of device {:} has not been calibrated".format(channel, device))
+            sens[row] = np.interp(logf, np.log2(curve[0]), curve[1])
+        return sens
+
+    def describe(self):
+        """Returns the table as text, one line per measurement."""
+        lines = [u"Calibration table {:}".format(self.filename or u"(not saved)")]
+        for (device, channel), curve in sorted(self.curves.items()):
+            lines.append(u"Device {:}, channel {:}:".format(device, channel))
+            for f, sens in curve.T:
+                lines.append(u"  {:>8.1f} Hz  {:>6.1f} dB SPL/V".format(f, sens))
+        return u"\n".join(lines)
+
+
+# The calibration table in use; see load_calibration()
+calibration = CalibrationTable()
+
+
+def load_calibration(filename=CALIBRATION_FILE):
+    """Loads the calibration table from filename (if it exists), which is also where it will be saved."""
+    global calibration
+    calibration = CalibrationTable(filename)
+    return calibration
+
+
+def apply_calibration(kind, p):
+    """Returns the parameters that play a stimulus at p["spl"] dB SPL on each of its output channels.
+
+        The sensitivities come from the calibration table, averaged, in power,
+        across the stimulus's spectrum (as given by the spectrum function of
+        its type; see register_stimulus). The level is set, by the level
+        function of its type, for the channel that needs the most voltage, and
+        the channel gains scale the others down, so the signal is still
+        generated once. Any channel gains in p are applied on top, as relative
+        gains. p itself is returned if p["spl"] is 0 (or the type has no spl
+        option), and the parameters returned have spl set to 0, so they aren't
+        calibrated twice.
+    """
+    if not p.get("spl"):
+        return p
+    gains = np.array(channel_gains(p["output"], p["gains"]))
+    freqs, weights = STIMULI[kind]["spectrum"](p)
+    power = 10. ** (calibration.sensitivity(p["device"], p["output"], freqs) / 10.)
+    sens = 10. * np.log10(np.dot(power, weights) / np.sum(weights))
+    # The rms voltage each channel needs
+    volts = 10. ** ((p["spl"] - sens) / 20.) * gains
+    peak = np.max(volts)
+    p = dict(p, spl=0., gains=NumberList(list(volts / peak)))
+    return STIMULI[kind]["level"](p, peak)
+
+
+# The spectrum of each stimulus type, for calibration: each function returns
+# frequencies, and the relative power of the stimulus at each
+
+def tone_spectrum(p):
+    return [p["frequency"]], [1.]
+
+
+def noise_spectrum(p):
+    # White within the band, so on log-spaced frequencies each is weighted by its share of the power per octave
+    freqs = np.geomspace(*band_edges(p["center"], p["bandwidth"]), num=32)
+    return freqs, freqs
+
+
+def shaped_spectrum(gain):
+    """Returns the spectrum function of noise shaped by gain(f), up to 20 kHz (or the Nyquist frequency)."""
+    def spectrum(p):
+        # Log-spaced frequencies, so each is weighted by its share of the power per octave
+        freqs = np.geomspace(PINK_LOW, min(20000., p["rate"] / 2.), num=64)
+        return freqs, gain(freqs) ** 2 * freqs
+    return spectrum
+
+
+def warble_spectrum(p):
+    # The frequency spends longest near the ends of its swing
+    f = p["frequency"] * (1. + p["deviation"] / 100. * np.sin(np.linspace(-np.pi / 2, np.pi / 2, 16)))
+    return f, np.ones(16)
+
+
+# How each stimulus type sets its level: each function returns the parameters
+# p, changed to play at an rms of volts
+
+def tone_level(p, volts):
+    return dict(p, amplitude=volts * np.sqrt(2.))
+
+
+def noise_level(p, volts):
+    p = dict(p, rms=volts, attenuation=0.)
+    if NOISE_ENGINES[p["filter"]][1] is butter_noise and not p["continuous"]:
+        # Butterworth noise has its rms set before it is filtered
+        p["rms"] = volts / np.sqrt(butter_power(p["center"], p["bandwidth"], p["rate"]))
+    return p
+
+
+def shaped_level(p, volts):
+    return dict(p, rms=volts, attenuation=0.)
+
+
+def record_level(p, measured):
+    """Records the level, in dB SPL, measured while playing the tone p, and saves the calibration table.
+
+        The sensitivity is recorded for each of the tone's output channels (so
+        route it to the channel being measured), and returned.
+    """
+    p = apply_calibration("tone", p)
+    volts = p["amplitude"] / np.sqrt(2.) * np.array(channel_gains(p["output"], p["gains"]))
+    sens = measured - 20. * np.log10(volts)
+    for channel, sn in zip(p["output"], sens):
+        calibration.record(p["device"], channel, p["frequency"], sn)
+    if calibration.filename:
+        calibration.save()
+    return sens
+
+
+# Menu options. Each option is a dict with:
+#   key:     The key to press to select this option (also its short command-line flag)
+#   name:    The name of the parameter (also its long command-line flag)
+#   desc:    A description of this option
+#   type:    The type of menu item this is; frame, func, or a var type
+#   val:     If frame or func, the name; if var type, holds the value
+#   cur_str: A format string to display the current value (var only)
+#   default: A default value, applied when no value is entered (var only)
+#   on_set:  The name of a menu method to call when the value is set (var only, optional)
+
+DEVICE_OPTIONS = [
                {"key": "i",
+                "name": "device",
                 "desc": "Portaudio device id",
                 "val": 0,
                 "cur_str": "[{:}]", 
@@ -367,6 +1764,7 @@ class Frame_Tone(get_input):
                 "type": int,
                },
                {"key": "s",
+                "name": "rate",
                 "desc": "Sample rate",
                 "val": 44100.,
                 "cur_str": "[{:} Hz]", 
@@ -374,6 +1772,7 @@ class Frame_Tone(get_input):
                 "type": float,
                },
                {"key": "n",
+                "name": "channels",
                 "desc": "Number of output channels",
                 "val": 2,
                 "cur_str": "[{:} channels]", 
@@ -381,69 +1780,77 @@ class Frame_Tone(get_input):
                 "type": int,
                },
                {"key": "o",
-                "desc": "Output channel",
-                "val": 1,
+                "name": "output",
+                "desc": "Output channels (eg. 1,2)",
+                "val": ChannelList(1),
                 "cur_str": "[channel {:}]", 
-                "default": 1,
+                "default": ChannelList(1),
+                "type": ChannelList,
+               },
+               {"key": "g",
+                "name": "gains",
+                "desc": "Channel gains (one, or one per channel)",
+                "val": NumberList(1.),
+                "cur_str": "[{:}]", 
+                "default": NumberList(1.),
+                "type": NumberList,
+               },
+               {"key": "j",
+                "name": "limit",
+                "desc": "Soft limiter (0=off, 1=on)",
+                "val": 0,
+                "cur_str": "[{:}]",
+                "default": 0,
                 "type": int,
                },
-                {"key": "p", 
-                 "desc": "Play stimulus",
-                 "type": "func",
-                 "val": "play",
-                },
-                {"key": "b",
-                 "desc": "Back",
-                 "type": "frame",
-                 "val": "Frame_Main",
-                },
-               ]
+              ]
 
-    def play(self):
+TONE_OPTIONS = [
+               {"key": "f",
+                "name": "frequency",
+                "desc": "Frequency",
+                "type": float,
+                "val": 1000.,
+                "cur_str": "[{:} Hz]",
+                "default": 1000.,
+               },
+               {"key": "a", 
+                "name": "amplitude",
+                "desc": "Amplitude",
+                "val": 1.,
+                "cur_str": "[{:} v]",  
+                "default": 1.,
+                "type": float,
+               },
+               {"key": "v",
+                "name": "spl",
+                "desc": "Level (dB SPL, 0=use amplitude)",
+                "val": 0.,
+                "cur_str": "[{:} dB SPL]",
+                "default": 0.,
+                "type": float,
+               },
+               {"key": "d", 
+                "name": "duration",
+                "desc": "Duration",
+                "val": 10.,
+                "cur_str": "[{:} s]", 
+                "default": 10.,
+                "type": float,
+               },
+               {"key": "m",
+                "name": "continuous",
+                "desc": "Continuous (0=off, 1=until stopped)",
+                "val": 0,
+                "cur_str": "[{:}]", 
+                "default": 0,
+                "type": int,
+               },
+              ] + DEVICE_OPTIONS
 
-        # Get values
-        i = self.options[ self.keys.index(ord('i')) ]["val"]
-        s = self.options[ self.keys.index(ord('s')) ]["val"]
-        n = self.options[ self.keys.index(ord('n')) ]["val"]
-        o = self.options[ self.keys.index(ord('o')) ]["val"]
-
-        f = self.options[ self.keys.index(ord('f')) ]["val"]
-        a = self.options[ self.keys.index(ord('a')) ]["val"]
-        d = self.options[ self.keys.index(ord('d')) ]["val"]
-
-        # Create tone
-        dur = np.int32((np.float32(d) * s))
-        freq = np.ones(dur) * f
-        signal = np.sin(2. * np.pi * np.cumsum(freq) / s)
-
-        # 20-ms ramps
-        rdur = np.int(np.round(.02*s))
-        rf = np.hanning(np.int32(2.*rdur))
-        signal[0:rdur] = signal[0:rdur] * rf[0:rdur]
-        signal[-(rdur-1):] = signal[-(rdur-1):] * rf[-(rdur-1):,]
-
-        dev = m.open_device(i,i,n)
-        stream = dev.open_array(signal, s)
-        mm = stream.mix_mat
-        mm[:] = 0
-        mm[o-1] = 1
-        stream.mix_mat = mm
-        self.disabled = True
-        inst = self._instructions.text
-        self._instructions.text = "Playing tone..."
-        self._screen.force_update()
-        stream.play()
-        while stream.is_playing:
-            time.sleep(.1)
-        self.disabled = False
-        self._instructions.text = inst
-        self._screen.force_update()
-
-
-class Frame_Noise(get_input):
-    nav = "Main / Noise"
-    options = [
+NOISE_OPTIONS = [
                {"key": "c", 
+                "name": "center",
                 "desc": "Center frequency",
                 "cur_str":  "[{:} Hz]", 
                 "val": 1000., 
@@ -451,6 +1858,7 @@ class Frame_Noise(get_input):
                 "type": float,
                },
                {"key": "w", 
+                "name": "bandwidth",
                 "desc": "Bandwidth",
                 "val": .333333,
                 "cur_str":  "[{:} oct]",  
@@ -458,6 +1866,7 @@ class Frame_Noise(get_input):
                 "type": float,
                },
                {"key": "r", 
+                "name": "rms",
                 "desc": "Root-mean-square",
                 "val": .18,
                 "cur_str":  "[{:} v]",  
@@ -465,126 +1874,1387 @@ class Frame_Noise(get_input):
                 "type": float,
                },
                {"key": "a", 
+                "name": "attenuation",
                 "desc": "Attenuation",
                 "val": 0.,
                 "cur_str":  "[{:} dB]", 
                 "type": float,
                 "default": 0.,
                },
+               {"key": "v",
+                "name": "spl",
+                "desc": "Level (dB SPL, 0=use rms and atten)",
+                "val": 0.,
+                "cur_str": "[{:} dB SPL]",
+                "default": 0.,
+                "type": float,
+               },
                {"key": "d",
+                "name": "duration",
                 "desc": "Duration",
                 "val": 10.,
                 "cur_str":  "[{:} s]", 
                 "default": 10.,
                 "type": float,
                },
-               {"key": "i",
-                "desc": "Portaudio device id",
+               {"key": "e",
+                "name": "filter",
+                "desc": "Filter (0=Butterworth, 1=FFT)",
                 "val": 0,
-                "cur_str": "[{:}]", 
+                "cur_str":  "[{:}]", 
                 "default": 0,
                 "type": int,
                },
-               {"key": "s",
-                "desc": "Sample rate",
-                "val": 44100.,
-                "cur_str": "[{:} Hz]", 
-                "default": 44100.,
+               {"key": "z",
+                "name": "token",
+                "desc": "Noise token (0=fresh, 1=frozen)",
+                "val": 0,
+                "cur_str":  "[{:}]", 
+                "default": 0,
+                "type": int,
+               },
+               {"key": "y",
+                "name": "seed",
+                "desc": "Noise seed (0=use token option)",
+                "val": 0,
+                "cur_str":  "[{:}]",
+                "default": 0,
+                "type": int,
+               },
+               {"key": "m",
+                "name": "continuous",
+                "desc": "Continuous (0=off, 1=until stopped)",
+                "val": 0,
+                "cur_str":  "[{:}]", 
+                "default": 0,
+                "type": int,
+               },
+              ] + DEVICE_OPTIONS
+
+# Options of broadband noise shaped to a spectrum (pink and speech-shaped noise)
+SHAPED_NOISE_OPTIONS = [
+               {"key": "r",
+                "name": "rms",
+                "desc": "Root-mean-square",
+                "val": .18,
+                "cur_str":  "[{:} v]",
+                "default": .18,
                 "type": float,
                },
-               {"key": "n",
-                "desc": "Number of output channels",
-                "val": 2,
-                "cur_str": "[{:} channels]", 
-                "default": 2,
+               {"key": "a",
+                "name": "attenuation",
+                "desc": "Attenuation",
+                "val": 0.,
+                "cur_str":  "[{:} dB]",
+                "type": float,
+                "default": 0.,
+               },
+               {"key": "v",
+                "name": "spl",
+                "desc": "Level (dB SPL, 0=use rms and atten)",
+                "val": 0.,
+                "cur_str": "[{:} dB SPL]",
+                "default": 0.,
+                "type": float,
+               },
+               {"key": "d",
+                "name": "duration",
+                "desc": "Duration",
+                "val": 10.,
+                "cur_str":  "[{:} s]",
+                "default": 10.,
+                "type": float,
+               },
+               {"key": "z",
+                "name": "token",
+                "desc": "Noise token (0=fresh, 1=frozen)",
+                "val": 0,
+                "cur_str":  "[{:}]",
+                "default": 0,
                 "type": int,
                },
-               {"key": "o",
-                "desc": "Output channel",
-                "val": 1,
-                "cur_str": "[channel {:}]", 
-                "default": 1,
+               {"key": "y",
+                "name": "seed",
+                "desc": "Noise seed (0=use token option)",
+                "val": 0,
+                "cur_str":  "[{:}]",
+                "default": 0,
+                "type": int,
+               },
+               {"key": "m",
+                "name": "continuous",
+                "desc": "Continuous (0=off, 1=until stopped)",
+                "val": 0,
+                "cur_str":  "[{:}]",
+                "default": 0,
                 "type": int,
                },
-               {"key": "p",
-                "desc": "Play stimulus",
-                "type": "func",
-                "val": "play",
+              ] + DEVICE_OPTIONS
+
+WARBLE_OPTIONS = [
+               {"key": "f",
+                "name": "frequency",
+                "desc": "Center frequency",
+                "type": float,
+                "val": 1000.,
+                "cur_str": "[{:} Hz]",
+                "default": 1000.,
+               },
+               {"key": "a",
+                "name": "amplitude",
+                "desc": "Amplitude",
+                "val": 1.,
+                "cur_str": "[{:} v]",
+                "default": 1.,
+                "type": float,
                },
-               {"key": "b",
-                "desc": "Back",
-                "type": "frame",
-                "val": "Frame_Main",
+               {"key": "v",
+                "name": "spl",
+                "desc": "Level (dB SPL, 0=use amplitude)",
+                "val": 0.,
+                "cur_str": "[{:} dB SPL]",
+                "default": 0.,
+                "type": float,
                },
-              ]
+               {"key": "r",
+                "name": "modulation",
+                "desc": "Modulation rate",
+                "val": 10.,
+                "cur_str": "[{:} Hz]",
+                "default": 10.,
+                "type": float,
+               },
+               {"key": "e",
+                "name": "deviation",
+                "desc": "Frequency deviation (either side)",
+                "val": 5.,
+                "cur_str": "[{:} %]",
+                "default": 5.,
+                "type": float,
+               },
+               {"key": "d",
+                "name": "duration",
+                "desc": "Duration",
+                "val": 10.,
+                "cur_str": "[{:} s]",
+                "default": 10.,
+                "type": float,
+               },
+               {"key": "m",
+                "name": "continuous",
+                "desc": "Continuous (0=off, 1=until stopped)",
+                "val": 0,
+                "cur_str": "[{:}]",
+                "default": 0,
+                "type": int,
+               },
+              ] + DEVICE_OPTIONS
+
+CLICK_OPTIONS = [
+               {"key": "a",
+                "name": "amplitude",
+                "desc": "Amplitude (peak)",
+                "val": 1.,
+                "cur_str": "[{:} v]",
+                "default": 1.,
+                "type": float,
+               },
+               {"key": "r",
+                "name": "repetition",
+                "desc": "Click rate",
+                "val": 20.,
+                "cur_str": "[{:} /s]",
+                "default": 20.,
+                "type": float,
+               },
+               {"key": "e",
+                "name": "width",
+                "desc": "Click width",
+                "val": 100.,
+                "cur_str": "[{:} us]",
+                "default": 100.,
+                "type": float,
+               },
+               {"key": "c",
+                "name": "polarity",
+                "desc": "Polarity (0=positive, 1=negative, 2=alternating)",
+                "val": 0,
+                "cur_str": "[{:}]",
+                "default": 0,
+                "type": int,
+               },
+               {"key": "d",
+                "name": "duration",
+                "desc": "Duration",
+                "val": 10.,
+                "cur_str": "[{:} s]",
+                "default": 10.,
+                "type": float,
+               },
+               {"key": "m",
+                "name": "continuous",
+                "desc": "Continuous (0=off, 1=until stopped)",
+                "val": 0,
+                "cur_str": "[{:}]",
+                "default": 0,
+                "type": int,
+               },
+              ] + DEVICE_OPTIONS
+
+
+def generated_source(key, make_blocks, total, text, peak=None):
+    """Returns the blocks, the length in samples, the peak, and the description of a generated stimulus.
+
+        make_blocks(block_size) returns a generator of the stimulus, whose
+        length is total samples (None if it has no end). A stimulus short
+        enough to cache is rendered once and cached under key, and its peak is
+        measured. Otherwise it is generated block by block as it plays, so it
+        doesn't need to fit in memory, and its peak is peak if that is known,
+        or else found by generating it once beforehand, a chunk at a time (for
+        a stimulus with no end, over its first chunk). make_blocks must give
+        the same stimulus each time it is called.
+    """
+    if total is not None and stimulus_cache.fits(total * np.dtype(DTYPE).itemsize):
+        signal = stimulus_cache.get(key)
+        if signal is None:
+            with timed("synthesis"):
+                blocks = []
+                for block in make_blocks(BLOCK_SIZE):
+                    check_cancelled()
+                    blocks.append(block)
+                signal = np.concatenate(blocks)
+            stimulus_cache.put(key, signal)
+        note_size("stimulus", signal.nbytes)
+        with timed("preflight"):
+            peak = signal_peak([signal])
+        return array_blocks(signal), total, peak, text
+    if peak is None:
+        with timed("preflight"):
+            chunks = make_blocks(FILE_CHUNK)
+            peak = signal_peak(chunks if total is not None else [next(chunks)])
+    return make_blocks(BLOCK_SIZE), total, peak, text
+
+
+def check_duration(p):
+    """Raises ValueError unless the sample rate in p is above 0, and its duration (unless continuous) is at least a sample."""
+    if p["rate"] <= 0:
+        raise ValueError("The sample rate must be more than 0 Hz")
+    if not p["continuous"] and int(np.float32(p["duration"]) * p["rate"]) < 1:
+        raise ValueError("The duration must be more than 0 s (at least one sample)")
+
+
+def tone_source(p, control=None):
+    """Returns the blocks, the length in samples (None if continuous), the peak, and a description of a tone.
+
+        p is a dict of tone parameters, keyed by option name. Short tones are
+        rendered once and cached. Longer ones are generated block by block as
+        they play, so they don't need to fit in memory. Continuous tones loop
+        a short buffer until stopped. If control (a LiveControl) is given, the
+        tone is always generated as it plays, so its frequency can be changed.
+        The peak of a rendered tone is measured; that of a generated one is
+        its amplitude.
+    """
+    check_duration(p)
+    f, a, d, s = p["frequency"], p["amplitude"], p["duration"], p["rate"]
+    if control is not None:
+        if p["continuous"]:
+            return tone_blocks(f, a, None, s, control=control), None, abs(a), u"Playing tone continuously;"
+        return tone_blocks(f, a, d, s, control=control), int(np.float32(d) * s), abs(a), u"Playing tone;"
+    if p["continuous"]:
+        key = ("tone-loop", f, a, s)
+        loop = stimulus_cache.get(key)
+        if loop is None:
+            with timed("synthesis"):
+                loop = tone_loop(f, a, s)
+            stimulus_cache.put(key, loop)
+        note_size("stimulus", loop.nbytes)
+        with timed("preflight"):
+            peak = signal_peak([loop])
+        cycles, samples = loop_cycles(f, s)
+        text = u"Playing tone continuously ({:.3f} Hz);".format(cycles * s / float(samples))
+        return loop_blocks(loop, s), None, peak, text
+
+    return generated_source(("tone", f, a, d, s), lambda block_size: tone_blocks(f, a, d, s, block_size),
+                            int(np.float32(d) * s), u"Playing tone;", peak=abs(a))
+
+
+# The seed last used for each set of noise parameters, for frozen tokens
+last_seeds = {}
+
+
+def noise_seed(p, key):
+    """Returns the seed to draw noise with parameters p from, and remembers it under key.
+
+        The seed is p["seed"], unless that is 0. Then a frozen token reuses
+        the seed last used under key, and a fresh token draws a new seed.
+        While a stimulus is being opened to play (see open_stimulus), the
+        seed is only remembered once it starts playing, in BlockPlayer.play.
+    """
+    seed = p["seed"]
+    if not seed:
+        seed = last_seeds.get(key) if p["token"] else None
+        seed = seed or new_seed()
+    timings = getattr(_timing, "current", None)
+    if timings is not None:
+        timings.seeds[key] = seed
+    else:
+        last_seeds[key] = seed
+    return seed
+
+
+def noise_source(p, control=None):
+    """Returns the blocks, the length in samples (None if continuous), the peak, and a description of a noise band.
+
+        p is a dict of noise parameters, keyed by option name. The noise is
+        drawn with p["seed"], which is shown in the description so the token
+        can be played again exactly. If the seed is 0, a frozen token reuses
+        the seed last used with the same parameters, and a fresh token draws a
+        new seed. Continuous noise loops a circular FFT token (whatever the
+        filter option) until stopped. Butterworth noise too long to cache is
+        filtered block by block as it plays; its peak is found by generating
+        it once beforehand, a chunk at a time, from the same seed. control is
+        not used, since only the level of a noise band can be adjusted live,
+        and the player does that.
+    """
+    check_duration(p)
+    c, w, r, a, d, s = p["center"], p["bandwidth"], p["rms"], p["attenuation"], p["duration"], p["rate"]
+    name, engine = NOISE_ENGINES[p["filter"]]
+    total = int(np.float32(d) * s)
+    if p["continuous"]:
+        name = "FFT, looped"
+        key = ("noise-loop", c, w, r, a, s)
+    else:
+        key = ("noise", name, c, w, r, a, d, s)
+    seed = noise_seed(p, key)
+    hp, lp = band_edges(c, w)
+    text = u"Playing noise ({:}); {:.0f}-{:.0f} Hz; seed {:};".format(name, hp, lp, seed)
+
+    if engine is butter_noise and not p["continuous"] and not stimulus_cache.fits(total * np.dtype(DTYPE).itemsize):
+        with timed("preflight"):
+            peak = signal_peak(butter_noise_blocks(c, w, r, a, d, s, block_size=FILE_CHUNK, seed=seed))
+        return butter_noise_blocks(c, w, r, a, d, s, seed=seed), total, peak, text
+
+    # The same seed always gives the same noise, so it can be cached by seed
+    key += (seed,)
+    signal = stimulus_cache.get(key)
+    if signal is None:
+        if p["continuous"]:
+            signal = fft_noise(c, w, r, a, LOOP_NOISE_DUR, s, circular=True, seed=seed)
+        else:
+            signal = engine(c, w, r, a, d, s, seed=seed)
+            with timed("ramps"):
+                apply_ramps(signal, 0, len(signal), hanning_ramp(s))
+        stimulus_cache.put(key, signal)
+    note_size("stimulus", signal.nbytes)
+    with timed("preflight"):
+        peak = signal_peak([signal])
+    if p["continuous"]:
+        return loop_blocks(signal, s), None, peak, text
+    return array_blocks(signal), len(signal), peak, text
+
+
+def shaped_noise_source(name, gain):
+    """Returns the source function of broadband noise shaped by gain(f) (see shaped_noise_blocks).
+
+        The noise is drawn from a seed as in noise_source. Continuous noise
+        is filtered from its seed, without end, as it plays. Its peak is found
+        over the first chunk, so for continuous noise it is an estimate.
+    """
+    def source(p, control=None):
+        check_duration(p)
+        r, a, d, s = p["rms"], p["attenuation"], p["duration"], p["rate"]
+        if p["continuous"]:
+            key, d, total = (name + "-loop", r, a, s), None, None
+        else:
+            key, total = (name, r, a, d, s), int(np.float32(d) * s)
+        seed = noise_seed(p, key)
+        text = u"Playing {:}{:}; seed {:};".format(name, u" continuously" if total is None else u"", seed)
+        return generated_source(key + (seed,),
+                                lambda block_size: shaped_noise_blocks(gain, r, a, d, s, block_size, seed=seed),
+                                total, text)
+    return source
 
-    def play(self):
 
-        # Get values
-        i = self.options[ self.keys.index(ord('i')) ]["val"]
-        s = self.options[ self.keys.index(ord('s')) ]["val"]
-        n = self.options[ self.keys.index(ord('n')) ]["val"]
-        o = self.options[ self.keys.index(ord('o')) ]["val"]
-
-        c = self.options[ self.keys.index(ord('c')) ]["val"]
-        w = self.options[ self.keys.index(ord('w')) ]["val"]
-        r = self.options[ self.keys.index(ord('r')) ]["val"]
-        a = self.options[ self.keys.index(ord('a')) ]["val"]
-        d = self.options[ self.keys.index(ord('d')) ]["val"]
-
-        # Create noise
-        signal = np.random.randn(np.int32(d*s))
-        # RMS
-        signal = signal * (r / np.sqrt(np.mean(np.square(signal))))
-        # Atten
-        signal = signal * np.exp(np.float32(-a)/8.6860)
-
-        # Filter
-        hp = np.round(c*(2.**np.float32(-w/2.)));
-        lp = np.round(c*(2.**np.float32(w/2.)));
-        bh,ah = scipy.signal.butter(6, hp/(s/2.), btype='high')
-        signal = scipy.signal.lfilter(bh, ah, signal)
-        bl,al = scipy.signal.butter(6, lp/(s/2.))
-        signal = scipy.signal.lfilter(bl, al, signal)
-
-        # 20-ms ramps
-        rdur = np.int(np.round(.02*s))
-        rf = np.hanning(np.int32(2.*rdur))
-        signal[0:rdur] = signal[0:rdur] * rf[0:rdur]
-        signal[-(rdur-1):] = signal[-(rdur-1):] * rf[-(rdur-1):,]
-
-        # Access hardware
-        dev = m.open_device(i,i,n)
-        stream = dev.open_array(signal, s)
-        mm = stream.mix_mat
-        mm[:] = 0
-        mm[o-1] = 1
-        stream.mix_mat = mm
-        self.disabled = True
-        inst = self._instructions.text
-        self._instructions.text = "Playing noise; {:}-{:} Hz".format(hp,lp)
-        self._screen.force_update()
-        self._screen.force_update()
-        stream.play()
-        while stream.is_playing:
-            time.sleep(.1)
-        self.disabled = False
-        self._instructions.text = inst
-        self._screen.force_update()
-
-
-def main(screen, scene):
-    scenes = [
-        am_scene.Scene([Frame_Main(screen)], -1, name="Frame_Main"),
-        am_scene.Scene([Frame_Tone(screen)], -1, name="Frame_Tone"),
-        am_scene.Scene([Frame_Noise(screen)], -1, name="Frame_Noise"),
-    ]
-    screen.play(scenes, stop_on_resize=True, start_scene=scene)
-
-last_scene = None
-while True:
+def warble_source(p, control=None):
+    """Returns the blocks, the length in samples (None if continuous), the peak, and a description of a warble tone.
+
+        As with a tone, a warble tone is rendered once if it is short enough
+        to cache, and otherwise generated as it plays; if control (a
+        LiveControl) is given, its center frequency can be changed as it plays.
+    """
+    check_duration(p)
+    f, a, fm, dev, s = p["frequency"], p["amplitude"], p["modulation"], p["deviation"] / 100., p["rate"]
+    d = None if p["continuous"] else p["duration"]
+    total = None if d is None else int(np.float32(d) * s)
+    text = u"Playing warble tone{:}; {:.0f}-{:.0f} Hz;".format(u" continuously" if d is None else u"",
+                                                               f * (1. - dev), f * (1. + dev))
+    if control is not None:
+        return warble_blocks(f, a, fm, dev, d, s, control=control), total, abs(a), text
+    return generated_source(("warble", f, a, fm, dev, d, s),
+                            lambda block_size: warble_blocks(f, a, fm, dev, d, s, block_size), total, text, peak=abs(a))
+
+
+def click_source(p, control=None):
+    """Returns the blocks, the length in samples (None if continuous), the peak, and a description of a click train."""
+    check_duration(p)
+    a, rate, width, polarity, s = p["amplitude"], p["repetition"], p["width"] * 1e-6, p["polarity"], p["rate"]
+    if rate <= 0:
+        raise ValueError("The repetition rate must be more than 0 clicks per second")
+    if width < 0:
+        raise ValueError("The click width can't be negative")
+    d = None if p["continuous"] else p["duration"]
+    total = None if d is None else int(np.float32(d) * s)
+    text = u"Playing clicks{:}; {:} /s; {:.0f} samples wide;".format(u" continuously" if d is None else u"",
+                                                                    rate, max(1, np.round(width * s)))
+    return generated_source(("clicks", a, rate, width, polarity, d, s),
+                            lambda block_size: click_blocks(a, rate, width, polarity, d, s, block_size),
+                            total, text, peak=abs(a))
+
+
+# Stimulus types; see register_stimulus()
+STIMULI = OrderedDict()
+
+
+def register_stimulus(kind, desc, key, options, source, spectrum=None, level=None, verify=None):
+    """Adds a stimulus type, which can then be played from the menu, the command line and batch files.
+
+        kind:     The name of the type (also its command)
+        desc:     What it plays, for the menu and help, eg. "pure tones"
+        key:      The key that selects its menu in the main menu
+        options:  Its parameters, as a list of menu options (see DEVICE_OPTIONS),
+                   which should end with DEVICE_OPTIONS
+        source:   A function, source(p, control=None), that returns the
+                   blocks, the length in samples (None if it has no end), the
+                   peak and a description of the stimulus with parameters p
+                   (see tone_source); the blocks are then cached, streamed,
+                   routed, limited and metered the same way for every type
+        spectrum: If it can be played at a level in dB SPL (its options
+                   include spl), spectrum(p) returns frequencies, and the
+                   relative power at each (see tone_spectrum)
+        level:    And level(p, volts) returns p changed to play at an rms of
+                   volts (see tone_level)
+        verify:   A self-test, verify(p, blocks, total), which returns a list
+                   of results (see check), or None if it has none
+    """
+    STIMULI[kind] = {"desc": desc,
+                     "key": key,
+                     "options": options,
+                     "source": source,
+                     "spectrum": spectrum,
+                     "level": level,
+                     "verify": verify,
+                    }
+
+
+def open_stimulus(kind, p, control=None, cancel=None):
+    """Returns a BlockPlayer, ready to play, and a description of a stimulus.
+
+        kind is a key of STIMULI, and p a dict of its parameters, keyed by
+        option name. The device is taken from the device pool, and the
+        stimulus is routed to the output channels in p. If control (a
+        LiveControl) is given, the stimulus can be adjusted as it plays.
+        If p["spl"] is set, the level comes from the calibration table.
+        The description includes the peak of the stimulus, found before it
+        plays, and warns if it would clip; p["limit"] turns on the soft limiter.
+
+        The time each stage takes, up to the stream starting, is kept in the
+        player's timings, which are logged when it starts playing. If cancel
+        (an Event) is set while the stimulus is being opened, Cancelled is
+        raised, between chunks of the work.
+    """
+    timings = Timings(kind, option_values(kind, p))
+    timings.cancel = cancel
+    with timings.active():
+        spl = p.get("spl")
+        with timed("calibration"):
+            p = apply_calibration(kind, p)
+        blocks, total, peak, text = STIMULI[kind]["source"](p, control)
+        if spl:
+            text += u" {:} dB SPL;".format(spl)
+        text += peak_text(peak, p)
+    return open_player(blocks, total, p, control, timings), text
+
+
+def open_player(blocks, total, p, control=None, timings=None):
+    """Returns a BlockPlayer for blocks, on the device and output channels given in p.
+
+        The device, stream and routing stages are added to timings (default: new Timings).
+    """
+    i, n, s = p["device"], p["channels"], p["rate"]
+    timings = timings or Timings()
+    with timings.active():
+        with timed("open_device"):
+            dev = device_pool.get(i, n, s)
+        player = BlockPlayer(dev, blocks, s, total=total, control=control,
+                             limiter=output_limiter(p), gain=output_gain(p))
+        device_pool.track((i, n, s), player)
+        with timed("route"):
+            route(player.stream, n, p["output"], p["gains"])
+    player.timings = timings
+    return player
+
+
+class Prerenderer(object):
+    """Opens the next stimulus in the background, so it starts as soon as it is asked for.
+
+        request() starts opening a stimulus (rendering it, opening its stream
+        and routing it) on a worker thread, in place of any earlier request. An
+        earlier request is cancelled: if it has started, it stops at the next
+        chunk of its work (see check_cancelled), and if it had already finished,
+        its player is discarded. take() returns the player and
+        description if they were opened with the same parameters, waiting for
+        them if they are still being opened, and None otherwise.
+    """
+    def __init__(self):
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._key = None
+        self._future = None
+        self._cancel_event = None
+
+    @staticmethod
+    def _request_key(kind, p, live):
+        return (kind, live, tuple(sorted(p.items())))
+
+    @staticmethod
+    def _open(kind, p, live, cancel):
+        player, text = open_stimulus(kind, p, LiveControl() if live else None, cancel)
+        player.timings.prerendered = True
+        return player, text
+
+    @staticmethod
+    def _discard(future):
+        if not future.cancelled() and future.exception() is None:
+            future.result()[0].discard()
+
+    def _cancel(self):
+        if self._future is not None and not self._future.cancel():
+            self._cancel_event.set()
+            self._future.add_done_callback(self._discard)
+        self._key = self._future = self._cancel_event = None
+
+    def request(self, kind, p, live=False):
+        """Starts opening a stimulus in the background; see open_stimulus. live asks for a LiveControl."""
+        with self._lock:
+            self._cancel()
+            self._key = self._request_key(kind, p, live)
+            self._cancel_event = threading.Event()
+            self._future = self._pool.submit(self._open, kind, dict(p), live, self._cancel_event)
+
+    def take(self, kind, p, live=False):
+        """Returns the (player, description) requested for these parameters, or None."""
+        with self._lock:
+            if self._future is None or self._key != self._request_key(kind, p, live):
+                self._cancel()
+                return None
+            future = self._future
+            self._key = self._future = self._cancel_event = None
+        try:
+            return future.result()
+        except Exception:
+            # Let the caller open it again, and report the error itself
+            return None
+
+    def cancel(self):
+        with self._lock:
+            self._cancel()
+
+
+# Shared by all of the menu screens
+prerenderer = Prerenderer()
+
+
+def write_stimulus(kind, p, filename):
+    """Returns a FileWriter, ready to write a stimulus to filename (.wav or .npy), and a description of it.
+
+        The file holds what would be played: the same ramps and level, routed
+        to the output channels in p, with a column for each of p["channels"].
+        Continuous stimuli are written for their duration.
+    """
+    spl = p.get("spl")
+    p = apply_calibration(kind, dict(p, continuous=0))
+    blocks, total, peak, text = STIMULI[kind]["source"](p)
+    if spl:
+        text += u" {:} dB SPL;".format(spl)
+    text += peak_text(peak, p)
+    limiter = output_limiter(p)
+    if limiter is not None:
+        # Limit copies, since the blocks can be views of a cached signal
+        blocks = (limiter(np.array(block)) for block in blocks)
+    mix = mix_gains(p["channels"], p["output"], p["gains"])
+    return FileWriter(filename, blocks, p["rate"], total, mix), text.replace(u"Playing", u"Writing", 1)
+
+
+def render_stimulus(kind, p):
+    """Renders a whole stimulus (which must not be continuous) to an array.
+
+        Returns the signal and a description of it.
+    """
+    blocks, total, _, text = STIMULI[kind]["source"](apply_calibration(kind, p))
+    return np.concatenate(list(blocks)), text
+
+
+class SpectrumAnalyzer(object):
+    """Estimates the power spectrum (by Welch's method) and rms of a signal, fed to it a block at a time.
+
+        Blocks are gathered into Hann-windowed segments of nperseg samples,
+        overlapping by half, and the periodograms of all the segments a block
+        completes are computed with one FFT call. Only the samples from start
+        up to stop (default: the end) are analysed, eg., to leave out the
+        ramps. Memory use is set by nperseg, not by the length of the signal.
+
+        If track (a frequency, in Hz) is given, the phase of the bin nearest
+        it is followed from segment to segment, and tracked_frequency() gives
+        the frequency of a tone in that bin from how fast its phase advances.
+    """
+    def __init__(self, s, nperseg, start=0, stop=None, track=None):
+        self.s = s
+        self.nperseg = nperseg
+        self.start = start
+        self.stop = stop
+        self._bin = None if track is None else int(round(track * nperseg / s))
+        self._last = None       # The tracked bin of the last segment
+        self._advance = 0j      # The sum of the phase advances from segment to segment
+        self.segments = 0
+        self.n = 0              # Samples analysed
+        self._window = np.hanning(nperseg + 1)[:-1]
+        self._power = np.zeros(nperseg // 2 + 1)
+        self._sumsq = 0.
+        self._pos = 0           # Position in the signal of the next block
+        self._buf = np.zeros(0)
+
+    def add(self, block):
+        lo = max(self.start - self._pos, 0)
+        hi = len(block) if self.stop is None else min(len(block), self.stop - self._pos)
+        self._pos += len(block)
+        if hi <= lo:
+            return
+        block = np.asarray(block[lo:hi], dtype=np.float64)
+        self._sumsq += np.dot(block, block)
+        self.n += len(block)
+        buf = np.concatenate([self._buf, block])
+        step = self.nperseg // 2
+        k = (len(buf) - self.nperseg) // step + 1
+        if k > 0:
+            segments = np.lib.stride_tricks.sliding_window_view(buf, self.nperseg)[::step][:k]
+            spec = scipy_fft().rfft(segments * self._window, axis=1, workers=-1)
+            self._power += np.sum(spec.real ** 2 + spec.imag ** 2, axis=0)
+            if self._bin is not None:
+                tracked = spec[:, self._bin]
+                if self._last is not None:
+                    tracked = np.concatenate([[self._last], tracked])
+                self._advance += np.sum(tracked[1:] * np.conj(tracked[:-1]))
+                self._last = tracked[-1]
+            self.segments += k
+            buf = buf[k*step:]
+        self._buf = buf
+
+    @property
+    def rms(self):
+        return np.sqrt(self._sumsq / max(self.n, 1))
+
+    def tracked_frequency(self):
+        """Returns the frequency, in Hz, of a tone within a bin of the one tracked.
+
+            Segments start half a segment apart, so the phase of the tone
+            advances by a whole number of half cycles per bin, plus a
+            fraction that gives its frequency to well within a bin.
+        """
+        frac = np.angle(self._advance) / (2. * np.pi)
+        cycles = np.round(self._bin / 2. - frac) + frac
+        return cycles * self.s / (self.nperseg // 2)
+
+    def psd(self):
+        """Returns the frequencies, and the one-sided power spectral density at each."""
+        psd = self._power * 2. / (max(self.segments, 1) * self.s * np.sum(self._window ** 2))
+        psd[0] /= 2.
+        if self.nperseg % 2 == 0:
+            psd[-1] /= 2.
+        return np.fft.rfftfreq(self.nperseg, 1. / self.s), psd
+
+
+def band_edges_3db(freqs, psd, c):
+    """Returns the frequencies, in Hz, at which a power spectrum falls 3 dB below its level at c.
+
+        The level at c is averaged over 5% either side of it, and the edges are
+        the first crossings going out from c (so noise in an estimated spectrum
+        beyond the band can't move them), interpolated between bins.
+    """
+    ref = 10. * np.log10(np.mean(psd[np.abs(freqs - c) <= c * .05])) - 3.
+    level = 10. * np.log10(psd + 1e-300)
+    mid = int(np.argmin(np.abs(freqs - c)))
+    below = np.flatnonzero(level[:mid] <= ref)
+    above = np.flatnonzero(level[mid:] <= ref)
+    lo = below[-1] + 1 if len(below) else 1
+    hi = mid + above[0] - 1 if len(above) else len(level) - 2
+    def cross(i, j):
+        return freqs[i] + (ref - level[i]) * (freqs[j] - freqs[i]) / (level[j] - level[i])
+    return cross(lo - 1, lo), cross(hi, hi + 1)
+
+
+def check(name, measured, unit, expected=None, tolerance=None):
+    """Returns a self-test result: measured is within tolerance of expected, or at most tolerance if there is no expected value."""
+    if expected is None:
+        ok = measured <= tolerance
+    else:
+        ok = abs(measured - expected) <= tolerance
+    return OrderedDict([("check", name), ("measured", float(measured)), ("expected", expected),
+                        ("tolerance", float(tolerance)), ("unit", unit), ("pass", bool(ok))])
+
+
+def verify_tone(p, blocks, total):
+    """Checks a tone's frequency, total harmonic distortion and rms against p.
+
+        Segments are up to 1 s long, so spectrum bins are 1 Hz apart. The
+        frequency is measured from the phase of the bin at the frequency
+        asked for (see SpectrumAnalyzer), or from the strongest bin if the
+        tone is not in that one. THD is the power at the harmonics (up to
+        the 10th, below the Nyquist frequency) relative to the fundamental,
+        each summed over the main lobe of the window.
+    """
+    f, a, s = p["frequency"], p["amplitude"], p["rate"]
+    if f <= 0:
+        raise ValueError("Only tones above 0 Hz can be checked")
+    rdur = len(hanning_ramp(s)) // 2
+    nperseg = int(min(s, (total - 2 * rdur) // 2)) // 2 * 2
+    if f * nperseg / s < 8:
+        # The harmonics would fall inside the main lobe of the fundamental
+        raise ValueError("A {:} Hz tone must be at least {:.2f} s long to check".format(
+            f, np.ceil((16. / f + 2. * RAMP_DUR) * 100. - 1e-6) / 100.))
+    an = SpectrumAnalyzer(s, nperseg, rdur, total - rdur, track=f)
+    for block in blocks:
+        an.add(block)
+    freqs, psd = an.psd()
+    df = freqs[1]
+    i = int(np.argmax(psd[1:-1])) + 1
+    if abs(i - f / df) <= 1:
+        measured = an.tracked_frequency()
+    else:
+        measured = freqs[i]
+    lobe = lambda j: np.sum(psd[max(j-3, 0):j+4])
+    harmonics = [h * measured for h in range(2, 11) if h * measured < s / 2. - 4 * df]
+    thd = sum(lobe(int(round(fh / df))) for fh in harmonics) / lobe(i)
+    return [
+            check("Frequency", measured, "Hz", f, VERIFY_FREQUENCY_TOL * f),
+            check("THD", 10. * np.log10(max(thd, 1e-30)), "dB", None, VERIFY_THD_MAX),
+            check("Rms", 20. * np.log10(an.rms), "dBFS", 20. * np.log10(abs(a) / np.sqrt(2.)), VERIFY_RMS_TOL),
+           ]
+
+
+def verify_noise(p, blocks, total):
+    """Checks a noise band's -3 dB edges, in-band flatness and rms against p.
+
+        The edges are where the level falls 3 dB below its level at c, and
+        are expected at the edges of the band asked for, whichever the engine.
+        Segments are long enough for 64 bins across the band, but no longer
+        than a quarter of the signal. Flatness is the range of the level
+        across 4 equal parts (in octaves) of the middle half of the band.
+
+        The spectrum of a noise token is only an estimate of that of the
+        noise, so each check allows for 3 standard deviations of its
+        estimate on top of its VERIFY_ tolerance: the levels of the parts,
+        the levels the edges are found from (which move an edge more where
+        the spectrum falls off slowly), and the rms of Butterworth noise,
+        which is set before filtering.
+    """
+    c, w, s = p["center"], p["bandwidth"], p["rate"]
+    name, engine = NOISE_ENGINES[p["filter"]]
+    rdur = len(hanning_ramp(s)) // 2
+    hp, lp = band_edges(c, w)
+    nperseg = 2 ** int(np.ceil(np.log2(64. * s / (lp - hp))))
+    nperseg = min(nperseg, 2 ** int(np.log2(max((total - 2 * rdur) // 4, 1))))
+    if (lp - hp) * nperseg / s < 16:
+        raise ValueError("This noise band must be at least {:.1f} s long to check".format(
+            np.ceil((4. * 2 ** np.ceil(np.log2(16. * s / (lp - hp))) / s + 2. * RAMP_DUR) * 10.) / 10.))
+    an = SpectrumAnalyzer(s, nperseg, rdur, total - rdur)
+    for block in blocks:
+        an.add(block)
+    freqs, psd = an.psd()
+    gain = p["rms"] * np.exp(np.float32(-p["attenuation"])/8.6860)
+    if engine is butter_noise:
+        # The filter passes only part of the noise
+        gain *= np.sqrt(butter_power(c, w, s))
+    # The standard deviation, in dB, of the mean level over that many bins (neighbouring
+    # bins of a Hann window are not independent, so they count as half a bin each)
+    spread = lambda bins: 10. / np.log(10.) / np.sqrt(bins / 2. * max(an.segments / 2., 1.))
+
+    # Smooth the estimate over 9 bins (of 64 or more across the band) before finding the edges,
+    # and measure the slope at each edge over as many bins either side, so that it isn't noisy too
+    smooth = np.convolve(psd, np.ones(9) / 9., mode="same")
+    lo, hi = band_edges_3db(freqs, smooth, c)
+    level = 10. * np.log10(smooth + 1e-300)
+    level_spread = np.hypot(spread(9), spread(np.count_nonzero(np.abs(freqs - c) <= c * .05)))
+    edge_tols = []
+    for edge, expected in [(lo, hp), (hi, lp)]:
+        i = int(np.clip(np.round(edge / freqs[1]), 9, len(freqs) - 10))
+        slope = abs(level[i+9] - level[i-9]) / (freqs[i+9] - freqs[i-9])
+        edge_tols.append(VERIFY_EDGE_TOL * expected + 3. * level_spread / max(slope, 1e-12))
+
+    parts = c * 2. ** (np.linspace(-w / 4., w / 4., 5))
+    levels, bins = [], []
+    for f0, f1 in zip(parts[:-1], parts[1:]):
+        inside = (freqs >= f0) & (freqs < f1)
+        levels.append(10. * np.log10(np.mean(psd[inside])))
+        bins.append(np.count_nonzero(inside))
+
+    rms_tol = VERIFY_RMS_TOL
+    if engine is butter_noise:
+        # The standard deviation, in dB, of the power of a band that wide over that long
+        rms_tol += 3. * 10. / np.log(10.) / np.sqrt((lp - hp) * an.n / s)
+    return [
+            check("Low edge", lo, "Hz", hp, edge_tols[0]),
+            check("High edge", hi, "Hz", lp, edge_tols[1]),
+            check("Flatness", max(levels) - min(levels), "dB", None, VERIFY_FLATNESS_TOL + 3. * spread(min(bins))),
+            check("Rms", 20. * np.log10(an.rms), "dBFS", 20. * np.log10(gain), rms_tol),
+           ]
+
+
+register_stimulus("tone", "pure tones", "t", TONE_OPTIONS, tone_source, tone_spectrum, tone_level, verify_tone)
+register_stimulus("noise", "noise bands", "n", NOISE_OPTIONS, noise_source, noise_spectrum, noise_level, verify_noise)
+register_stimulus("pink", "pink noise", "p", SHAPED_NOISE_OPTIONS, shaped_noise_source("pink noise", pink_gain),
+                  shaped_spectrum(pink_gain), shaped_level)
+register_stimulus("speech", "speech-shaped noise", "s", SHAPED_NOISE_OPTIONS,
+                  shaped_noise_source("speech-shaped noise", speech_gain), shaped_spectrum(speech_gain), shaped_level)
+register_stimulus("warble", "warble tones", "w", WARBLE_OPTIONS, warble_source, warble_spectrum, tone_level)
+register_stimulus("clicks", "click trains", "c", CLICK_OPTIONS, click_source)
+
+
+def verify_stimulus(kind, p):
+    """Analyses a stimulus, rendered as it would be played, and checks it against its parameters.
+
+        The stimulus is analysed a block at a time as it is generated, so long
+        ones don't need to fit in memory, and the ramps are left out.
+        Continuous stimuli are checked for their duration. Returns a list of
+        results (see check), and a description of the stimulus. Raises
+        ValueError if the stimulus type has no self-test.
+    """
+    if STIMULI[kind]["verify"] is None:
+        raise ValueError("There is no self-test for {:}".format(STIMULI[kind]["desc"]))
+    spl = p.get("spl")
+    p = apply_calibration(kind, dict(p, continuous=0))
+    blocks, total, _, text = STIMULI[kind]["source"](p)
+    if spl:
+        text += u" {:} dB SPL;".format(spl)
+    return STIMULI[kind]["verify"](p, blocks, total), text.replace(u"Playing", u"Checking", 1)
+
+
+def verify_text(results):
+    """Returns a table of self-test results, one per line."""
+    lines = [u"{:<20}{:>14}{:>14}{:>12}  {:<8}".format("Check", "measured", "expected", "tolerance", "unit")]
+    for r in results:
+        expected = u"max" if r["expected"] is None else u"{:.4f}".format(r["expected"])
+        lines.append(u"{:<20}{:>14.4f}{:>14}{:>12.3g}  {:<8}{:}".format(
+            r["check"], r["measured"], expected, r["tolerance"], r["unit"], u"ok" if r["pass"] else u"FAIL"))
+    return u"\n".join(lines)
+
+
+def verify_summary(results):
+    """Returns self-test results as one line of text."""
+    return u"; ".join(u"{:} {:.4g} {:} {:}".format(r["check"], r["measured"], r["unit"], u"ok" if r["pass"] else u"FAIL")
+                      for r in results)
+
+
+def run_verify(kind=None, p=None):
+    """Checks a stimulus (or, if kind is None, the default stimulus of each type with a self-test) from the command line.
+
+        Prints the results, and returns True if every check passed.
+    """
+    if kind is None:
+        tests = [(k, defaults(k)) for k in STIMULI if STIMULI[k]["verify"] is not None]
+    else:
+        tests = [(kind, p)]
+    passed = True
+    for kind, p in tests:
+        results, text = verify_stimulus(kind, p)
+        print(text.rstrip(u";"))
+        print(verify_text(results))
+        print(u"")
+        passed = passed and all(r["pass"] for r in results)
+    return passed
+
+
+# Standard audiometric frequencies, in Hz
+AUDIOMETRIC_FREQUENCIES = [125., 250., 500., 750., 1000., 1500., 2000., 3000., 4000., 6000., 8000.]
+
+
+def sweep_steps(p, frequencies, levels=None, outputs=None):
+    """Returns the tone parameters for each step of a frequency sweep.
+
+        p holds the tone parameters common to every step. levels are
+        amplitudes, one for all frequencies or one per frequency (default: the
+        amplitude in p). The sweep steps through every frequency on each of
+        outputs in turn (default: once, on the output channels in p). If
+        p["spl"] is set, every step plays at that level, using the calibration
+        table, whatever the levels.
+    """
+    levels = levels or [p["amplitude"]]
+    if len(levels) == 1:
+        levels = levels * len(frequencies)
+    if len(levels) != len(frequencies):
+        raise ValueError("Give one level, or one level per frequency")
+    steps = []
+    for o in outputs or [p["output"]]:
+        for f, a in zip(frequencies, levels):
+            step = dict(p)
+            step.update(frequency=f, amplitude=a, output=ChannelList(o), continuous=0)
+            steps.append(apply_calibration("tone", step))
+    return steps
+
+
+class Sweep(object):
+    """Plays a sequence of tones, rendering the upcoming ones in a thread pool while the current one plays.
+
+        steps is a list of tone parameter dicts, eg., from sweep_steps. Up to
+        lookahead steps are rendered ahead of the one playing, so consecutive
+        steps play with no generation gap between them. gap is the silence
+        between steps, in s. The steps can be of another stimulus type, kind,
+        given render(p), which returns the signal of step p (eg., a band of a
+        filter bank; see bank_sweep).
+
+        A Sweep is played like a BlockPlayer: play() returns immediately,
+        and stop(), wait(), done, add_done_callback() and progress() work the
+        same way. report holds a dict for each step played, with its
+        frequency (or center frequency), amplitude (or rms), generation time
+        (gen_s), how long it played (play_s), the time
+        between the end of the previous step and the start of this one that
+        was not part of the requested gap (gap_s), and its highest peak
+        (peak_dbfs).
+    """
+    # Sweeps can't be adjusted live, and each step has its own timings
+    control = None
+    timings = None
+
+    def __init__(self, steps, gap=0., lookahead=2, kind="tone", render=None):
+        self.steps = steps
+        self.gap = gap
+        self.lookahead = lookahead
+        self.kind = kind
+        self.render = render or (lambda p: render_stimulus("tone", p)[0])
+        self.report = []
+        self.done = threading.Event()
+        self.current = None         # The BlockPlayer of the step playing
+        self._step = 0
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _render(self, p):
+        t0 = time.time()
+        signal = self.render(p)
+        return signal, time.time() - t0
+
+    @staticmethod
+    def _frequency(p):
+        return p["frequency"] if "frequency" in p else p["center"]
+
+    def _run(self):
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.lookahead)
+        futures = {}
+        last_end = None
+        try:
+            for num, p in enumerate(self.steps):
+                for ahead in range(num, min(num + self.lookahead + 1, len(self.steps))):
+                    if ahead not in futures:
+                        futures[ahead] = pool.submit(self._render, self.steps[ahead])
+                signal, gen_s = futures.pop(num).result()
+                if last_end is not None:
+                    self._stop.wait(max(0., last_end + self.gap - time.time()))
+                if self._stop.is_set():
+                    break
+                self._step = num
+                self.current = open_player(array_blocks(signal), len(signal), p,
+                                           timings=Timings("sweep", option_values(self.kind, p)))
+                t0 = time.time()
+                self.current.play()
+                row = {"frequency": self._frequency(p), "amplitude": p["amplitude"] if "amplitude" in p else p["rms"],
+                       "output": str(p["output"]),
+                       "gen_s": gen_s, "gap_s": 0. if last_end is None else max(0., t0 - last_end - self.gap)}
+                self.current.wait()
+                last_end = time.time()
+                row["play_s"] = last_end - t0
+                row["peak_dbfs"] = float(dbfs(self.current.meter.max_peak))
+                self.report.append(row)
+        finally:
+            for future in futures.values():
+                future.cancel()
+            pool.shutdown(wait=False)
+            with self._lock:
+                self.done.set()
+                callbacks = list(self._callbacks)
+            for func in callbacks:
+                func(self)
+
+    def add_done_callback(self, func):
+        """Calls func(sweep) when the sweep ends, or right away if it already has."""
+        with self._lock:
+            if not self.done.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def play(self, requested=None):
+        # requested is only used by BlockPlayer
+        self._thread.start()
+
+    def stop(self, fade=True):
+        self._stop.set()
+        if self.current is not None:
+            self.current.stop(fade)
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    @property
+    def is_playing(self):
+        return self._thread.is_alive()
+
+    def progress(self):
+        p = self.steps[self._step]
+        text = u"step {:} of {:}, {:.5g} Hz, channel {:}".format(self._step+1, len(self.steps), self._frequency(p),
+                                                                 p["output"])
+        if self.current is not None:
+            text += u"; " + self.current.progress()
+        return text
+
+    def levels(self):
+        """Returns the levels of the step playing, as text."""
+        if self.current is None:
+            return u""
+        return self.current.levels()
+
+    def summary(self):
+        """Returns a short text summary of the generation times and gaps of the steps played."""
+        if not self.report:
+            return u"No sweep steps played"
+        return u"Sweep: {:} steps; generation max {:.0f} ms; gaps max {:.1f} ms".format(
+            len(self.report), 1000 * max(r["gen_s"] for r in self.report), 1000 * max(r["gap_s"] for r in self.report))
+
+
+def bank_steps(p, centers, outputs=None):
+    """Returns the noise parameters for each band of a filter bank, in the order they play.
+
+        p holds the noise parameters common to every band, and centers the
+        center frequencies of the bands, each p["bandwidth"] wide. Each step
+        has the index of its band in centers as "band". The bands are played
+        on each of outputs in turn (default: once, on the output channels in
+        p). If p["spl"] is set, every band plays at that level, using the
+        calibration table.
+    """
+    steps = []
+    for o in outputs or [p["output"]]:
+        for band, c in enumerate(centers):
+            step = dict(p)
+            step.update(center=c, band=band, filter=1, continuous=0, output=ChannelList(o))
+            steps.append(apply_calibration("noise", step))
+    return steps
+
+
+def bank_sweep(p, low=BANK_LOW, high=BANK_HIGH, outputs=None, gap=0.):
+    """Returns a Sweep that steps through the fractional-octave noise bands from low to high, their levels, and a description.
+
+        The bands are p["bandwidth"] wide (see octave_bands), and are split
+        from a single draw of noise, p["duration"] long, by noise_bank, so the
+        whole bank is generated in one pass rather than once per band. The
+        noise is drawn from a seed, as in noise_source. The levels are a dict
+        for each step, with its output channel, band center and edges, and
+        rms and peak in dBFS, measured on the bank before it plays. See
+        bank_steps for the other parameters.
+    """
+    centers, edges = octave_bands(p["bandwidth"], low, high)
+    seed = noise_seed(p, ("bank", tuple(edges), p["duration"], p["rate"]))
+    bank = noise_bank(edges, 1., 0., p["duration"], p["rate"], seed=seed)
+    rms, peak = bank_levels(bank)
+    steps = bank_steps(p, centers, outputs)
+    levels = []
+    for step in steps:
+        gain = step["rms"] * np.exp(-step["attenuation"]/8.6860)
+        levels.append({"output": str(step["output"]), "center": centers[step["band"]],
+                       "low": edges[step["band"]], "high": edges[step["band"] + 1],
+                       "rms_dbfs": float(dbfs(rms[step["band"]] * gain)), "peak_dbfs": float(dbfs(peak[step["band"]] * gain))})
+    render = lambda step: bank[step["band"]] * np.asarray(step["rms"] * np.exp(-step["attenuation"]/8.6860), bank.dtype)
+    text = u"Playing filter bank; {:} bands, {:.0f}-{:.0f} Hz; seed {:};".format(len(centers), edges[0], edges[-1], seed)
+    return Sweep(steps, gap, kind="noise", render=render), levels, text
+
+
+def bank_text(levels):
+    """Returns the band levels from bank_sweep as a table, one line per band."""
+    lines = [u"{:>8}{:>12}{:>18}{:>12}{:>12}".format("channel", "center (Hz)", "band (Hz)", "rms (dBFS)", "peak (dBFS)")]
+    for row in levels:
+        lines.append(u"{:>8}{:>12.1f}{:>18}{:>12.1f}{:>12.1f}".format(
+            row["output"], row["center"], u"{:.0f}-{:.0f}".format(row["low"], row["high"]), row["rms_dbfs"], row["peak_dbfs"]))
+    return u"\n".join(lines)
+
+
+def bank_summary(levels):
+    """Returns the range of the band levels from bank_sweep as one line of text."""
+    rms = [row["rms_dbfs"] for row in levels]
+    return u"Bands: rms {:.1f} to {:.1f} dBFS; peak max {:.1f} dBFS".format(
+        min(rms), max(rms), max(row["peak_dbfs"] for row in levels))
+
+
+def defaults(kind):
+    """Returns a dict of the default parameters for a stimulus type."""
+    return dict((opt["name"], opt["default"]) for opt in STIMULI[kind]["options"])
+
+
+def option_values(kind, p):
+    """Returns the parameters in p that are options of a stimulus type."""
+    return OrderedDict((opt["name"], p[opt["name"]]) for opt in STIMULI[kind]["options"])
+
+
+def run_stimulus(kind, p, until_stopped=True, filename=None):
+    """Plays a stimulus and waits for it to finish. Ctrl-C stops it early.
+
+        A continuous stimulus plays until Ctrl-C if until_stopped is True, and
+        for its duration otherwise. If filename is given, the stimulus is
+        written to it instead of played. The highest peak is printed at the end.
+    """
+    requested = time.perf_counter()
+    if filename:
+        player, text = write_stimulus(kind, p, filename)
+    else:
+        player, text = open_stimulus(kind, p)
+    print(text.rstrip(u";"))
+    try:
+        player.play(requested)
+        if p.get("continuous") and not until_stopped:
+            player.wait(p["duration"])
+            player.stop()
+        while not player.wait(.1):
+            pass
+    except KeyboardInterrupt:
+        player.stop()
+        player.wait()
+    if filename:
+        print(player.summary())
+    print(player.levels())
+    return player
+
+
+def read_batch(filename):
+    """Reads a calibration sequence from a JSON or CSV file.
+
+        A JSON file holds a list of objects; a CSV file has a header row. Each
+        step names its stimulus type (eg. "tone" or "noise") under "stimulus",
+        and any of that type's parameters by option name. Parameters left out
+        (or blank, in a CSV file) take their default values. Returns a list of
+        (stimulus type, parameter dict) pairs.
+    """
+    if filename.lower().endswith(".json"):
+        with open(filename) as fid:
+            rows = json.load(fid)
+    else:
+        with open(filename) as fid:
+            rows = list(csv.DictReader(fid))
+    steps = []
+    for num, row in enumerate(rows):
+        try:
+            steps.append(stimulus_params(row))
+        except ValueError as e:
+            raise ValueError("Step {:}: {:}".format(num+1, e))
+    return steps
+
+
+def stimulus_params(row):
+    """Returns the stimulus type and parameters given by a dict, eg., a step of a calibration sequence.
+
+        The type is row["stimulus"], and its parameters are keyed by option
+        name, as strings or values. Parameters left out (or blank) take
+        their default values, and other keys are ignored. Raises ValueError
+        if the type is unknown or a value can't be converted.
+    """
+    kind = row.get("stimulus")
+    if not isinstance(kind, str) or kind not in STIMULI:
+        raise ValueError("unknown stimulus {!r}".format(kind))
+    p = defaults(kind)
+    for opt in STIMULI[kind]["options"]:
+        val = row.get(opt["name"])
+        if val not in (None, ""):
+            try:
+                p[opt["name"]] = opt["type"](val)
+            except (TypeError, ValueError):
+                raise ValueError("bad {:} {!r}".format(opt["name"], val))
+    return kind, p
+
+
+def run_batch(steps, pause=0., prompt=False):
+    """Plays a calibration sequence, as returned by read_batch, one step after another."""
+    for num, (kind, p) in enumerate(steps):
+        if prompt:
+            input(u"Step {:} of {:}: press enter to play".format(num+1, len(steps)))
+        else:
+            print(u"Step {:} of {:}".format(num+1, len(steps)))
+        run_stimulus(kind, p, until_stopped=False)
+        time.sleep(pause)
+
+
+def run_sweep(args):
+    """Plays a sweep from the command line, and prints each step's generation and play times."""
+    steps = sweep_steps(args, args["frequencies"], args["levels"], args["outputs"])
+    sweep = Sweep(steps, gap=args["gap"])
+    try:
+        sweep.play()
+        while not sweep.wait(.1):
+            pass
+    except KeyboardInterrupt:
+        sweep.stop()
+        sweep.wait()
+    print(u"{:>8}{:>12}{:>8}{:>10}{:>10}{:>10}{:>12}".format("channel", "freq (Hz)", "amp", "gen (s)", "play (s)", "gap (s)",
+                                                         "peak (dBFS)"))
+    for row in sweep.report:
+        print(u"{:>8}{:>12}{:>8.4g}{:>10.3f}{:>10.3f}{:>10.4f}{:>12.1f}".format(
+            row["output"], row["frequency"], row["amplitude"], row["gen_s"], row["play_s"], row["gap_s"], row["peak_dbfs"]))
+    print(sweep.summary())
+    return sweep
+
+
+def run_bank(args):
+    """Plays a filter bank from the command line, after printing the level of each band.
+
+        With args["levels_only"], only the levels are printed.
+    """
+    sweep, levels, text = bank_sweep(args, args["low"], args["high"], args["outputs"], args["gap"])
+    if args["levels_only"]:
+        print(text.replace(u"Playing", u"Generated", 1).rstrip(u";"))
+    else:
+        print(text.rstrip(u";"))
+    print(bank_text(levels))
+    print(bank_summary(levels))
+    if args["levels_only"]:
+        return sweep
+    try:
+        sweep.play()
+        while not sweep.wait(.1):
+            pass
+    except KeyboardInterrupt:
+        sweep.stop()
+        sweep.wait()
+    print(sweep.summary())
+    return sweep
+
+
+def add_options(parser, options, leave_out=()):
+    """Adds a flag for each of options, except those named in leave_out, to an argparse parser."""
+    for opt in options:
+        if opt["name"] not in leave_out:
+            parser.add_argument("-" + opt["key"], "--" + opt["name"], type=opt["type"],
+                                default=opt["default"],
+                                help="{:} (default: {:})".format(opt["desc"], opt["default"]))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Play tones, noise and clicks, to calibrate headphones. "
+                    "With no command, calibrate runs its full-screen menu.")
+    parser.add_argument("--backend", choices=["medussa", "null"], default="medussa",
+                        help="Audio backend; null plays nothing, for testing without hardware")
+    parser.add_argument("--dtype", choices=["float32", "float64"], default="float32",
+                        help="Data type that signals are generated in (default: float32)")
+    parser.add_argument("--timing-log", default=TIMING_LOG,
+                        help="Append the timings of each stimulus to this file, as JSON lines; "
+                             "'' to not log them (default: {:})".format(TIMING_LOG))
+    parser.add_argument("--calibration", default=CALIBRATION_FILE,
+                        help="Calibration table, used for levels in dB SPL (default: {:})".format(CALIBRATION_FILE))
+    commands = parser.add_subparsers(dest="command")
+    for kind, entry in STIMULI.items():
+        sub = commands.add_parser(kind, help="Play {:}".format(entry["desc"]))
+        add_options(sub, entry["options"])
+        sub.add_argument("--write", metavar="FILE",
+                         help="Write the stimulus to a .wav or .npy file instead of playing it")
+    sub = commands.add_parser("sweep", help="Play a tone at each of a list of frequencies")
+    add_options(sub, TONE_OPTIONS, ["frequency", "continuous"])
+    sub.add_argument("--frequencies", type=float, nargs="+", default=AUDIOMETRIC_FREQUENCIES,
+                     help="Frequencies, in Hz (default: audiometric frequencies from 125 to 8000 Hz)")
+    sub.add_argument("--levels", type=float, nargs="+",
+                     help="Amplitudes, one for all frequencies or one per frequency (default: --amplitude)")
+    sub.add_argument("--outputs", type=ChannelList, nargs="+",
+                     help="Output channels to sweep, one after another, eg. 1 2 (default: --output)")
+    sub.add_argument("--gap", type=float, default=0.,
+                     help="Silence between steps, in s (default: 0)")
+    sub = commands.add_parser("bank", help="Play each of the fractional-octave noise bands from --low to --high in turn, "
+                                           "split from a single draw of noise")
+    add_options(sub, NOISE_OPTIONS, ["center", "filter", "continuous"])
+    sub.add_argument("--low", type=float, default=BANK_LOW,
+                     help="Center frequency of the lowest band, in Hz (default: {:})".format(BANK_LOW))
+    sub.add_argument("--high", type=float, default=BANK_HIGH,
+                     help="Center frequency of the highest band, in Hz (default: {:})".format(BANK_HIGH))
+    sub.add_argument("--outputs", type=ChannelList, nargs="+",
+                     help="Output channels to play the bands on, one after another, eg. 1 2 (default: --output)")
+    sub.add_argument("--gap", type=float, default=0.,
+                     help="Silence between bands, in s (default: 0)")
+    sub.add_argument("--levels-only", action="store_true",
+                     help="Print the level of each band without playing them")
+    sub = commands.add_parser("record", help="Record the level measured for a tone in the calibration table")
+    add_options(sub, TONE_OPTIONS, ["duration", "continuous", "limit"])
+    sub.add_argument("measured", type=float, help="The level measured, in dB SPL")
+    commands.add_parser("table", help="Print the calibration table")
+    sub = commands.add_parser("verify", help="Check the spectrum of a stimulus against its parameters "
+                                             "(with no stimulus, of the default stimulus of each type)")
+    kinds = sub.add_subparsers(dest="kind")
+    for kind, entry in STIMULI.items():
+        if entry["verify"] is not None:
+            add_options(kinds.add_parser(kind, help="Check {:}".format(entry["desc"])), entry["options"],
+                        ["continuous", "limit"])
+    sub = commands.add_parser("serve", help="Play stimuli asked for by other programs, as JSON lines over a local socket")
+    sub.add_argument("--host", default="127.0.0.1",
+                     help="Address to listen on (default: 127.0.0.1, ie. this machine only)")
+    sub.add_argument("--port", type=int, default=CONTROL_PORT,
+                     help="TCP port to listen on; 0 picks a free one (default: {:})".format(CONTROL_PORT))
+    sub.add_argument("--unix", metavar="PATH",
+                     help="Listen on a UNIX socket at PATH instead of a TCP port")
+    sub = commands.add_parser("batch", help="Play a calibration sequence from a JSON or CSV file")
+    sub.add_argument("filename")
+    sub.add_argument("--pause", type=float, default=0.,
+                     help="Silence between steps, in s (default: 0)")
+    sub.add_argument("--prompt", action="store_true",
+                     help="Wait for enter before each step")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.backend == "null":
+        use_backend(NullBackend())
+    set_dtype(args.dtype)
+    set_timing_log(args.timing_log)
+    load_calibration(args.calibration)
     try:
-        am_screen.Screen.wrapper(main, catch_interrupt=True, arguments=[last_scene])
-        sys.exit(0)
-    except am_exceptions.ResizeScreenError as e:
-        last_scene = e.scene
+        if args.command is None:
+            # The menu is only imported when it's needed, so scripts that use
+            # calibrate headless don't pay for asciimatics
+            import calibrate_ui
+            calibrate_ui.run()
+        elif args.command == "sweep":
+            run_sweep(vars(args))
+        elif args.command == "bank":
+            run_bank(vars(args))
+        elif args.command == "record":
+            for channel, sens in zip(args.output, record_level(vars(args), args.measured)):
+                print(u"Channel {:}: {:.1f} dB SPL/V at {:} Hz".format(channel, sens, args.frequency))
+        elif args.command == "table":
+            print(calibration.describe())
+        elif args.command == "verify":
+            if not run_verify(args.kind, vars(args)):
+                return 1
+        elif args.command == "serve":
+            # Like the menu, the server is only imported when it's needed
+            import calibrate_server
+            calibrate_server.run(args.host, args.port, args.unix)
+        elif args.command == "batch":
+            run_batch(read_batch(args.filename), pause=args.pause, prompt=args.prompt)
+        else:
+            run_stimulus(args.command, vars(args), filename=args.write)
+    except ValueError as e:
+        # Bad parameters, eg. an output channel the device doesn't have
+        sys.stderr.write(u"Error: {:}\n".format(e))
+        return 1
+    finally:
+        device_pool.close_all()
+
+
+if __name__ == "__main__":
+    # Let the menu, which imports calibrate, share this module's state
+    sys.modules.setdefault("calibrate", sys.modules[__name__])
+    sys.exit(main())
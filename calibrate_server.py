@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Christopher Brown
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this script.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Bug reports, bug fixes, suggestions, enhancements, or other
+# contributions are welcome. Go to http://www.github.com/cbrown1/calibrate
+# for more information and to contribute. Or send an e-mail to:
+# cbrown1@pitt.edu.
+#
+
+"""A local control server, so that experiment software can play stimuli without the menu.
+
+    Clients connect over TCP (to localhost, by default) or a UNIX socket,
+    and send requests as JSON objects, one per line. Every reply is a JSON
+    object on a line of its own, with the "id" of the request it answers
+    (if the request had one) and an "event":
+
+      {"id": 1, "stimulus": "tone", "frequency": 500, "duration": 2, "output": "1,2"}
+        Plays a stimulus, with its parameters keyed by option name, as in a
+        batch file (parameters left out take their defaults). It is queued
+        behind any stimulus playing, unless "preempt" is true, in which case
+        the queue is cleared and the stimulus playing is faded out. Replies
+        "queued", then "started" (with the description and the timings of
+        each stage, including the latency), then "finished" (with how long it
+        played, its highest peak, and whether it was stopped). A queued
+        request that is cleared gets "cancelled" instead. Continuous stimuli
+        play until stopped or preempted.
+      {"command": "stop"}
+        Fades out the stimulus playing, and clears the queue. Replies "stopped".
+      {"command": "status"}
+        Replies "status", with the stimulus playing, the number queued, and
+        the devices open.
+      {"command": "ping"}
+        Replies "pong".
+
+    Bad requests get an "error" reply. Stimuli play one at a time, in the
+    order they were asked for, whichever client asked. Devices are kept
+    open between stimuli (see calibrate.DevicePool), and the stimulus at
+    the head of the queue is opened in the background while the one before
+    it plays (see calibrate.Prerenderer), so it starts straight away.
+"""
+
+import os
+import stat
+import time
+import json
+import asyncio
+import collections
+
+import calibrate as cal
+
+
+class Job(object):
+    """A request to play a stimulus, and the client to send its replies to."""
+    def __init__(self, client, msg_id, kind, p, preempt=False):
+        self.client = client
+        self.id = msg_id
+        self.kind = kind
+        self.p = p
+        self.preempt = preempt
+        self.received = time.perf_counter()
+        self.cancelled = False
+
+
+class ControlServer(object):
+    """Plays the stimuli that clients ask for, one at a time; see the module docstring for the protocol."""
+
+    def __init__(self):
+        self.queue = collections.deque()
+        self.job = None         # The job playing (or being opened)
+        self.player = None      # Its BlockPlayer, once open
+        self._wake = None
+
+    def send(self, client, msg_id, event, **fields):
+        """Sends a reply to a client, if it is still connected."""
+        if client.is_closing():
+            return
+        reply = {"event": event}
+        if msg_id is not None:
+            reply["id"] = msg_id
+        reply.update(fields)
+        client.write((json.dumps(reply, default=str) + "\n").encode("utf8"))
+
+    async def handle(self, reader, writer):
+        """Reads requests from one client until it disconnects."""
+        while True:
+            try:
+                line = await reader.readline()
+            except (ConnectionError, ValueError):
+                # Disconnected, or a line too long to be a request
+                break
+            except asyncio.CancelledError:
+                # The server is shutting down
+                break
+            if not line:
+                break
+            if not line.strip():
+                continue
+            msg_id = None
+            try:
+                msg = json.loads(line.decode("utf8"))
+                if not isinstance(msg, dict):
+                    raise ValueError("a request is a JSON object")
+                msg_id = msg.get("id")
+                self.dispatch(writer, msg_id, msg)
+            except (TypeError, ValueError) as e:
+                # Values of the wrong type, eg. a list where a name should be
+                self.send(writer, msg_id, "error", error=str(e))
+            try:
+                await writer.drain()
+            except ConnectionError:
+                break
+        writer.close()
+
+    def dispatch(self, client, msg_id, msg):
+        command = msg.get("command", "play")
+        if command == "play":
+            kind, p = cal.stimulus_params(msg)
+            unknown = set(msg) - set(p) - set(["id", "command", "stimulus", "preempt"])
+            if unknown:
+                raise ValueError("unknown parameter(s) for {:}: {:}".format(kind, ", ".join(sorted(unknown))))
+            job = Job(client, msg_id, kind, p, bool(msg.get("preempt")))
+            if job.preempt:
+                self.clear()
+            self.queue.append(job)
+            self.send(client, msg_id, "queued", position=len(self.queue) - 1 + (self.job is not None))
+            if len(self.queue) == 1 and self.player is not None:
+                self.prerender_next()
+            self._wake.set()
+        elif command == "stop":
+            self.clear()
+            self.send(client, msg_id, "stopped")
+        elif command == "status":
+            self.send(client, msg_id, "status",
+                      playing=None if self.job is None else {"stimulus": self.job.kind, "id": self.job.id},
+                      progress=None if self.player is None else self.player.progress(),
+                      queued=len(self.queue), devices=cal.device_pool.status())
+        elif command == "ping":
+            self.send(client, msg_id, "pong")
+        else:
+            raise ValueError("unknown command {!r}".format(command))
+
+    def prerender_next(self):
+        """Opens the stimulus at the head of the queue in the background."""
+        cal.prerenderer.request(self.queue[0].kind, self.queue[0].p)
+
+    def clear(self):
+        """Cancels the queued jobs, and fades out the one playing."""
+        while self.queue:
+            job = self.queue.popleft()
+            self.send(job.client, job.id, "cancelled")
+        cal.prerenderer.cancel()
+        if self.job is not None:
+            self.job.cancelled = True
+            if self.player is not None:
+                self.player.stop()
+
+    async def run(self):
+        """Plays queued jobs, one after another, until cancelled."""
+        loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        while True:
+            if not self.queue:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            self.job = job = self.queue.popleft()
+            try:
+                await self.play(loop, job)
+            except ValueError as e:
+                # Bad parameters, eg. an output channel the device doesn't have
+                self.send(job.client, job.id, "error", error=str(e))
+            except Exception as e:
+                # Keep serving the other requests
+                self.send(job.client, job.id, "error", error=u"{:}: {:}".format(type(e).__name__, e))
+            finally:
+                self.job = self.player = None
+
+    async def play(self, loop, job):
+        requested = time.perf_counter()
+        opened = await loop.run_in_executor(None, cal.prerenderer.take, job.kind, job.p)
+        if opened is None:
+            opened = await loop.run_in_executor(None, cal.open_stimulus, job.kind, job.p)
+        player, text = opened
+        if job.cancelled:
+            player.discard()
+            self.send(job.client, job.id, "cancelled")
+            return
+        self.player = player
+        finished = loop.create_future()
+        player.add_done_callback(lambda player: loop.call_soon_threadsafe(finished.set_result, None))
+        player.play(requested)
+        started = time.perf_counter()
+        self.send(job.client, job.id, "started", stimulus=job.kind, text=text.rstrip(u";"),
+                  wait_ms=round((requested - job.received) * 1e3, 3), timings=player.timings.record())
+        if self.queue:
+            self.prerender_next()
+        await finished
+        self.send(job.client, job.id, "finished", played_s=round(time.perf_counter() - started, 3),
+                  stopped=job.cancelled, peak_dbfs=round(float(cal.dbfs(player.meter.max_peak)), 2),
+                  clipped=player.meter.clipped)
+
+
+def is_socket(path):
+    """Returns True if there is a UNIX socket at path."""
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+async def serve(host="127.0.0.1", port=cal.CONTROL_PORT, path=None, ready=None):
+    """Runs a ControlServer on a TCP port (0 picks a free one), or on a UNIX socket at path, until cancelled.
+
+        A socket left at path (eg. by a server that was killed) is replaced,
+        but anything else there raises ValueError. ready(address) is called
+        once it is listening.
+    """
+    if path and os.path.lexists(path):
+        if not is_socket(path):
+            raise ValueError("{:} exists and is not a socket; give another path".format(path))
+        os.remove(path)
+    server = ControlServer()
+    runner = asyncio.ensure_future(server.run())
+    if path:
+        listener = await asyncio.start_unix_server(server.handle, path)
+        address = path
+    else:
+        listener = await asyncio.start_server(server.handle, host, port)
+        address = u"{:}:{:}".format(*listener.sockets[0].getsockname()[:2])
+    if ready is not None:
+        ready(address)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        runner.cancel()
+        server.clear()
+        if path and is_socket(path):
+            os.remove(path)
+
+
+def run(host="127.0.0.1", port=cal.CONTROL_PORT, path=None):
+    """Runs the control server until Ctrl-C."""
+    cal.prewarm()
+    try:
+        asyncio.run(serve(host, port, path, ready=lambda address: print(u"Listening on {:}".format(address), flush=True)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cal.prerenderer.cancel()
@@ -0,0 +1,657 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Christopher Brown
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this script.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Bug reports, bug fixes, suggestions, enhancements, or other 
+# contributions are welcome. Go to http://www.github.com/cbrown1/calibrate 
+# for more information and to contribute. Or send an e-mail to: 
+# cbrown1@pitt.edu.
+#
+
+import copy
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import asciimatics as am
+import asciimatics.widgets as am_widgets
+import asciimatics.scene as am_scene
+import asciimatics.screen as am_screen
+import asciimatics.exceptions as am_exceptions
+from asciimatics.event import KeyboardEvent
+from collections import defaultdict
+
+import calibrate as cal
+
+
+# Keys that adjust a stimulus while it plays in live mode, and the
+# (dB, cents) each one nudges it by
+LIVE_KEYS = {
+             ord('+'): (1., 0.),
+             ord('='): (1., 0.),
+             ord('-'): (-1., 0.),
+             ord(']'): (.1, 0.),
+             ord('['): (-.1, 0.),
+             ord('>'): (0., 10.),
+             ord('<'): (0., -10.),
+             ord('}'): (0., 1.),
+             ord('{'): (0., -1.),
+            }
+
+# The live mode option, shared by the menu of every stimulus type
+LIVE_OPTION = {"key": "l",
+               "desc": "Live adjust (0=off, 1=on)",
+               "val": 0,
+               "cur_str": "[{:}]",
+               "default": 0,
+               "type": int,
+              }
+
+
+class get_input(am_widgets.Frame):
+    
+    """A generic full-screen menu form that can handle three types of menu options:
+        
+          - asciimatics frames: move back and forth between menu screens (am frames)
+          - functions: run arbitrary functions, with access to all available data
+          - variables: update variables, display their current state, specify 
+              defaults & (numeric) var types. Var types must be numeric (float, int, 
+              etc, or a comma-separated list of numbers) at this point. This is because the interface is designed to make
+              navigation as efficient as possible, so that a single keypress is 
+              interpreted as a menu selection. Since letter keys are used for menus,
+              if letters were allowed to be used in updating variables, it would be 
+              impossible to know which was intended by the user. The usecase also 
+              required many numeric variables but no text, so this is not a problem. 
+
+
+    """
+    # The stimulus type of the menu, if it plays one
+    kind = None
+
+    def __init__(self, screen):
+        super(get_input, self).__init__(screen,
+                                        screen.height,
+                                        screen.width,
+                                        title="Calibrate!",
+                                        reduce_cpu=True)
+
+        self.number_keys = set([ord('1'), ord('2'), ord('3'), ord('4'), ord('5'), ord('6'), ord('7'), ord('8'), ord('9'), ord('0'), ord('.'), ord(',') ])
+        layout1 = am_widgets.Layout([1], fill_frame=False)
+        layout2 = am_widgets.Layout([2,8], fill_frame=False)
+        layout3 = am_widgets.Layout([91,9], fill_frame=False)
+        self._nav = am_widgets.Label(self.nav)
+        self._hl = am_widgets.Divider()
+        self._blankline = am_widgets.Divider(height=1, draw_line=False)
+        self._psylab = am_widgets.Label(u"psylab")
+        # The listbox takes up 1 more line than is visible, because quit is added after
+        # the height is computed. So setting height to FILL_FRAME pushes the bottom line 
+        # of the visible screen. There are 13 additional lines on the screen other than
+        # the listbox (including 2 for the timings panel), so subtract 13 from screen. 
+        list_height = self._screen.height - 13 
+        self._list = am_widgets.ListBox(
+            list_height,
+#            am_widgets.Widget.FILL_FRAME,
+            options=[],
+            on_change=self._on_change,
+            on_select=self._on_select,
+            name="list_main",
+            )
+        self.enter_key = u"\u21B2"
+        # The index of the option for each key code, and the option for each parameter name
+        self._key_index = {}
+        self._params = {}
+        n = 0
+        has_val = False
+        for val in self.options:
+            if len(val['desc']) > n:
+                n = len(val['desc'])
+            if val['type'] not in ["frame", "func"]:
+                has_val = True
+        fmt_key  = u"    {}{} :  "
+        fmt_desc = u"{{:{:}}}".format(n)
+        fmt_cur_ = u"   {}"
+        keys = [val["key"] for val in self.options] + ["q"]
+        assert len(set(keys)) == len(keys), "each option (and quit, q) needs a key of its own: {:}".format(keys)
+        for i, val in enumerate(self.options):
+            val["fmt_key"] = fmt_key
+            val["fmt_desc"] = fmt_desc.format(val["desc"])
+            if "cur_str" in val:
+                val["fmt_cur"] = fmt_cur_.format(val["cur_str"])
+            else:
+                val["fmt_cur"] = ""
+            self._key_index[ord(val["key"])] = i
+            if "name" in val:
+                self._params[val["name"]] = val
+        if has_val:
+            expl = u"Option :  " + fmt_desc.format("Explanation") + u"   [value]"
+        else:
+            expl = u"Option :  Explanation"
+        self._explain = am_widgets.Label(expl)
+        self.instructions_no_opt = u"Choose an option"
+        self.instructions_opt = u"Choose an option or type value (blank=default), enter to update."
+        self._instructions = am_widgets.Label(self.instructions_no_opt)
+        self._status = am_widgets.Label(u"")
+        # The output level of the stimulus playing, and the highest peak of the last one
+        self._levels = am_widgets.Label(u"")
+        # The timings of the last stimulus started, shown when toggled on
+        self._timings = am_widgets.Label(u"", height=2)
+        self._show_timings = False
+        self._last_timings = None
+        self._input_label = am_widgets.Label("Enter a value: ")
+        self._input = am_widgets.Text(name="input")
+        self.add_layout(layout1)
+        self.add_layout(layout2)
+        self.add_layout(layout3)
+        layout1.add_widget(self._nav)
+        layout1.add_widget(self._hl)
+        layout1.add_widget(self._explain)
+        layout1.add_widget(self._blankline)
+        layout1.add_widget(self._list)
+        layout2.add_widget(self._input_label)
+        layout2.add_widget(self._input, column=1)
+        layout2.add_widget(self._blankline)
+        layout3.add_widget(self._instructions)
+        layout3.add_widget(self._psylab, column=1)
+        layout3.add_widget(self._status)
+        layout3.add_widget(self._levels)
+        layout3.add_widget(self._timings)
+        self.fix()
+        self._input.disabled = True
+        self._input_label.disabled = True
+        self.current_type = None
+        # The stimulus currently playing, and a queue of finished ones
+        self._player = None
+        self._player_text = u""
+        self._finished = queue.Queue()
+        # The listbox rows are only re-rendered when a value or the selection changes
+        self._dirty = True
+#        self._list.value = 0
+#        self._list._on_select()
+
+        # Add my own colour palette
+        self.palette = defaultdict(
+            lambda: (am_screen.Screen.COLOUR_WHITE, am_screen.Screen.A_NORMAL, am_screen.Screen.COLOUR_BLACK))
+        for key in ["selected_focus_field", "label"]:
+            self.palette[key] = (am_screen.Screen.COLOUR_WHITE, am_screen.Screen.A_BOLD, am_screen.Screen.COLOUR_BLACK)
+        self.palette["title"] = (am_screen.Screen.COLOUR_BLACK, am_screen.Screen.A_BOLD, am_screen.Screen.COLOUR_WHITE)
+        self.palette["disabled"] = (am_screen.Screen.COLOUR_BLACK, am_screen.Screen.A_NORMAL, am_screen.Screen.COLOUR_BLACK)
+
+
+    def process_event(self, event):
+
+        unhandled = True
+        if isinstance(event, am.event.KeyboardEvent):
+
+
+            # self._scene.add_effect(
+            #    am_widgets.PopUpDialog(self._screen,
+            #                            "{:}".format(event.key_code),
+            #                            ["Cancel", "OK"],
+            #                            on_close=self._confirm_quit))
+            if self._player is not None and self._player.control is not None and event.key_code in LIVE_KEYS:
+                # Nudge the level, or the frequency if it has one, of the stimulus playing
+                db, cents = LIVE_KEYS[event.key_code]
+                if db or "frequency" in self._player.params:
+                    self._player.control.nudge(db, cents)
+                unhandled = False
+
+            elif event.key_code in self._key_index:
+                self._list.value = self._key_index[event.key_code]
+                self._list._on_select()
+                unhandled = False
+
+            elif event.key_code in [ord('q')]:
+                self._list.value = len(self.options)
+                self._list._on_select()
+                unhandled = False
+
+            elif self._list.value != None:
+                # self._scene.add_effect(
+                #   am_widgets.PopUpDialog(self._screen,
+                #                           "Value!",
+                #                           ["Cancel", "OK"],
+                #                           on_close=self._confirm_quit))
+                if self._list.value < len(self.options):
+                    # self._scene.add_effect(
+                    #   am_widgets.PopUpDialog(self._screen,
+                    #                           "Option!",
+                    #                           ["Cancel", "OK"],
+                    #                           on_close=self._confirm_quit))
+                    if self.options[self._list.value]["type"] not in ['frame', 'func']:
+                        # self._scene.add_effect(
+                        #   am_widgets.PopUpDialog(self._screen,
+                        #                           "Var!",
+                        #                           ["Cancel", "OK"],
+                        #                           on_close=self._confirm_quit))
+                        if event.key_code in [10]:
+                            # User hit enter. Update 
+                            if self._input.value == "":
+                                # Textbox has no value, update the selected var with default
+                                self.options[self._list.value]["val"] = self.options[self._list.value]["default"]
+                            else:
+                                # Textbox is not empty; Update the selected var with val from textbox
+                                self.options[self._list.value]["val"] = self.options[self._list.value]["type"](self._input.value)
+                            if self.options[self._list.value].get("name") in ["device", "rate", "channels"]:
+                                # A device option changed; close devices that no longer match
+                                cal.device_pool.evict(keep=self.device_key())
+                                self._status.text = cal.device_pool.status()
+                            if "on_set" in self.options[self._list.value]:
+                                # The option acts on its value as soon as it is set
+                                try:
+                                    getattr(self, self.options[self._list.value]["on_set"])()
+                                except ValueError as e:
+                                    self._status.text = u"Error: {:}".format(e)
+                            self._list._on_select()
+                            self.prerender()
+                            # Empty the textbox
+                            self._input.value = ""
+                            unhandled = False
+
+                        elif event.key_code in [-300]:
+                            # Backspace key; delete last character in textbox
+                            self._input.value = self._input.value[:-1]
+                            unhandled = False
+                        elif event.key_code in self.number_keys:
+                            self._input.value = self._input.value + chr(event.key_code)
+                            unhandled = False
+        
+        if unhandled:
+            # Pass unhandled events to lower levels for normal handling
+            return super(get_input, self).process_event(event)
+
+
+    def _on_select(self):
+
+        if self._list.value == len(self.options):
+            self._scene.add_effect(
+                am_widgets.PopUpDialog(self._screen,
+                                        "Really quit?",
+                                        ["No", "Yes"],
+                                        on_close=self._confirm_quit))
+
+        elif self.options[self._list.value]["type"] == "frame":
+            # Item is a frame; Go there
+            self.next_scene(self.options[self._list.value]["val"])
+
+        elif self.options[self._list.value]["type"] == "func":
+            # Item is a function; Call it. Bad option values (eg., an output channel
+            # the device doesn't have) are reported in the status line
+            try:
+                ret = getattr(self, self.options[self._list.value]["val"])()
+            except ValueError as e:
+                self._status.text = u"Error: {:}".format(e)
+
+        else:
+            # Re-populate the listbox to update the value that changed
+            self._dirty = True
+
+
+    def _on_change(self):
+
+        if self._list.value != None: 
+            if self._list.value < len(self.options):
+                if self.options[self._list.value]["type"] in ["func", "frame"]:
+                    self._instructions.text = self.instructions_no_opt
+                    self._input.disabled = True
+                    self._input_label.disabled = True
+                    self._input_label.custom_colour = self.palette['label']
+                    self._input.blur()
+                else:
+                    self._instructions.text = self.instructions_opt
+                    self._input.disabled = False
+                    self._input_label.disabled = False
+                    self._input_label.custom_colour = self.palette['disabled']
+                    self._input.focus()
+
+            elif self._list.value == len(self.options):
+                # Quit; update in case user cancels
+                self._instructions.text = self.instructions_no_opt
+                self._input.disabled = True
+                self._input_label.disabled = True
+                self._input_label.custom_colour = self.palette['label']
+                self._input.blur()
+
+        # The selected row has a different prompt
+        self._dirty = True
+
+
+    def reset(self):
+        super(get_input, self).reset()
+        self._dirty = True
+        self.prerender()
+
+    def populate_list(self):
+
+        # Get current value of the listbox
+        value = self._list.value
+        options_l = []
+        for i, val in enumerate(self.options):
+            if i == value and val["type"] not in ["func", "frame"]:
+                # This listbox item is the selected on; use special prompt (pound sign & enter char)
+                key = val["fmt_key"].format(u"#", self.enter_key)
+            else:
+                # This listbox item is not the selected on; use normal prompt (a char)
+                key = val["fmt_key"].format(val['key'], u" ")
+            # fmt_desc is already expanded since it doesn't change
+            desc = val["fmt_desc"]
+            if "val" in val:
+                cur_val = val["fmt_cur"].format(val["val"])
+            else:
+                cur_val = ""
+            options_l.append((key + desc + cur_val, len(options_l)))
+
+        # Add quit to the list
+        key = val["fmt_key"].format("q", u" ")
+
+        options_l.append((key+"Quit", len(options_l)))
+
+        # Assign the newly created options to the listbox
+        self._list.options = options_l
+        # Select the previously selected option
+        self._list.value = value
+
+
+    def _update(self, frame_no):
+
+        if self._dirty:
+            self._dirty = False
+            self.populate_list()
+
+        # Handle stimuli that have finished playing
+        while True:
+            try:
+                player = self._finished.get_nowait()
+            except queue.Empty:
+                break
+            if player.control is not None:
+                # Keep the adjustments made while it played, to the options it was started with
+                self.set_values(player.control.adjusted(player.params))
+                self.prerender()
+            if player is self._player:
+                self._player = None
+                self._levels.text = player.levels()
+                if isinstance(player, (cal.Sweep, cal.FileWriter)):
+                    self._status.text = player.summary()
+                else:
+                    self._status.text = cal.device_pool.status() + u"; " + cal.stimulus_cache.status()
+        if self._player is not None:
+            if isinstance(self._player, cal.Sweep) and self._player.current is not None:
+                self.update_timings(self._player.current.timings)
+            self._status.text = self._player_text + u" " + self._player.progress()
+            self._levels.text = self._player.levels()
+            if self._player.control is not None:
+                self._status.text = (self._player_text + u" " + self._player.control.status() + u" " +
+                                     self._player.progress() + u"  (+/- [/] dB, </> {/} cents)")
+
+#        elif value == len(self.options):
+#            self._scene.add_effect(
+#                am_widgets.PopUpDialog(self._screen,
+#                            "Really quit?",
+#                            ["No", "Yes"],
+#                            on_close=self._confirm_quit))
+
+        super(get_input, self)._update(frame_no)
+
+    @property
+    def frame_update_count(self):
+        # Keep redrawing while a stimulus plays, so the progress stays current
+        if self._player is not None:
+            return 2
+        return super(get_input, self).frame_update_count
+
+    def start_player(self, player, text, requested=None):
+        """Starts a BlockPlayer (or Sweep) in the background, stopping any stimulus already playing.
+
+            Progress is shown in the status line, preceded by text. requested
+            is when the stimulus was asked for, to measure latency (see BlockPlayer.play).
+            The options it was started with are kept as player.params.
+        """
+        self.stop()
+        self._player = player
+        self._player_text = text
+        player.params = self.values()
+        player.add_done_callback(self._finished.put)
+        player.play(requested)
+        self.update_timings(player.timings)
+
+    def play(self):
+        """Plays the stimulus, using the one opened ahead of time if its options haven't changed since."""
+        requested = time.perf_counter()
+        opened = cal.prerenderer.take(self.kind, self.values(), self.live())
+        if opened is None:
+            opened = cal.open_stimulus(self.kind, self.values(), self.live_control())
+        self.start_player(*opened, requested=requested)
+        # Get the next one ready
+        self.prerender()
+
+    def prerender(self):
+        """Opens the stimulus for the current options in the background, so play() can start it straight away."""
+        if self.kind is None:
+            cal.prerenderer.cancel()
+        else:
+            cal.prerenderer.request(self.kind, self.values(), self.live())
+
+    def update_timings(self, timings):
+        """Shows timings (if not None) in the timings panel, if it is on."""
+        if timings is not None:
+            self._last_timings = timings
+        if self._show_timings and self._last_timings is not None:
+            self._timings.text = u"Timings " + self._last_timings.summary()
+        else:
+            self._timings.text = u""
+
+    def toggle_timings(self):
+        self._show_timings = not self._show_timings
+        self.update_timings(None)
+
+    def stop(self):
+        if self._player is not None:
+            self._player.stop()
+
+    def values(self):
+        """Returns a dict of the current value of each parameter, keyed by option name."""
+        return dict((name, opt["val"]) for name, opt in self._params.items())
+
+    def write(self):
+        """Writes the stimulus, as it would be played, to a WAV file in the current directory."""
+        filename = u"{:}_{:}.wav".format(self.kind, time.strftime("%Y%m%d-%H%M%S"))
+        self.start_player(*cal.write_stimulus(self.kind, self.values(), filename))
+
+    def verify(self):
+        """Checks the spectrum of the stimulus against its options, and shows the results below the status line."""
+        results, text = cal.verify_stimulus(self.kind, self.values())
+        failed = [r["check"] for r in results if not r["pass"]]
+        if failed:
+            self._status.text = text + u" FAILED: " + u", ".join(failed)
+        else:
+            self._status.text = text + u" all checks passed"
+        self._levels.text = cal.verify_summary(results)
+
+    def set_values(self, values):
+        """Sets parameters from a dict keyed by option name."""
+        for name in values:
+            self._params[name]["val"] = values[name]
+        self._dirty = True
+
+    def live(self):
+        """Returns True if live mode is on."""
+        return bool(self.options[ self._key_index[ord('l')] ]["val"])
+
+    def live_control(self):
+        """Returns a LiveControl if live mode is on, for the stimulus about to play, and None if it is off."""
+        if self.live():
+            return cal.LiveControl()
+        return None
+
+    def device_key(self):
+        """Returns the device pool key for the current device options."""
+        return (self._params["device"]["val"], self._params["channels"]["val"], self._params["rate"]["val"])
+
+    @staticmethod
+    def _confirm_quit(selected):
+        # Yes is the second button
+        if selected == 1:
+            raise am_exceptions.StopApplication("User requested exit")
+
+    @staticmethod
+    def next_scene(frame):
+        raise am_exceptions.NextScene(frame)
+
+
+def frame_name(kind):
+    """Returns the scene name of the menu for a stimulus type."""
+    return "Frame_" + kind.capitalize()
+
+
+class Frame_Main(get_input):
+
+    nav = "Main"
+    options = [
+               {"key": entry["key"],
+                "desc": u"Use " + entry["desc"],
+                "type": "frame",
+                "val": frame_name(kind),
+               } for kind, entry in cal.STIMULI.items()
+              ]
+
+
+# Menu options shared by the menu of every stimulus type
+STIMULUS_FUNCS = [
+                  {"key": "p",
+                   "desc": "Play stimulus",
+                   "type": "func",
+                   "val": "play",
+                  },
+                  {"key": "x",
+                   "desc": "Stop stimulus",
+                   "type": "func",
+                   "val": "stop",
+                  },
+                  {"key": "k",
+                   "desc": "Write stimulus to file",
+                   "type": "func",
+                   "val": "write",
+                  },
+                  {"key": "h",
+                   "desc": "Check stimulus spectrum",
+                   "type": "func",
+                   "val": "verify",
+                  },
+                  {"key": "t",
+                   "desc": "Show/hide timings",
+                   "type": "func",
+                   "val": "toggle_timings",
+                  },
+                 ]
+
+
+def stimulus_frame(kind, base=get_input, extra=()):
+    """Returns the menu frame class for a stimulus type in cal.STIMULI.
+
+        The menu has the type's options, live mode, the shared functions
+        (leaving out the spectrum check if the type has no self-test), then
+        extra options, whose methods base provides, and back.
+    """
+    funcs = [opt for opt in STIMULUS_FUNCS if opt["val"] != "verify" or cal.STIMULI[kind]["verify"]]
+    options = copy.deepcopy(cal.STIMULI[kind]["options"] + [LIVE_OPTION] + funcs + list(extra)) + [
+               {"key": "b",
+                "desc": "Back",
+                "type": "frame",
+                "val": "Frame_Main",
+               },
+              ]
+    return type(frame_name(kind), (base,), {"nav": u"Main / " + kind.capitalize(), "kind": kind, "options": options})
+
+
+class ToneMenu(get_input):
+    """The tone menu's extras: calibrating a channel, and sweeping frequencies."""
+
+    def record_level(self):
+        # Store the level just measured, with the current tone options, in the calibration table
+        measured = self.options[ self._key_index[ord('u')] ]["val"]
+        if measured:
+            p = self.values()
+            sens = cal.record_level(p, measured)
+            self._status.text = u"Recorded {:} dB SPL/V at {:} Hz".format(
+                u",".join(u"{:.1f}".format(sn) for sn in sens), p["frequency"])
+
+    def sweep(self):
+        # Step through the audiometric frequencies with the current tone options
+        steps = cal.sweep_steps(self.values(), cal.AUDIOMETRIC_FREQUENCIES)
+        self.start_player(cal.Sweep(steps), u"Sweep;")
+
+
+class NoiseMenu(get_input):
+    """The noise menu's extra: stepping through a filter bank."""
+
+    def bank(self):
+        # Step through the 1/3-octave (or bandwidth) bands from 125 to 8000 Hz, split from one draw of noise
+        sweep, levels, _ = cal.bank_sweep(self.values())
+        self.start_player(sweep, cal.bank_summary(levels) + u";")
+
+
+# The base class and extra options of the menus that have more than the shared options
+MENU_EXTRAS = {
+               "tone": (ToneMenu, [
+                         {"key": "u",
+                          "desc": "Measured level, to calibrate",
+                          "val": 0.,
+                          "cur_str": "[{:} dB SPL]",
+                          "default": 0.,
+                          "type": float,
+                          "on_set": "record_level",
+                         },
+                         {"key": "w",
+                          "desc": "Sweep audiometric frequencies",
+                          "type": "func",
+                          "val": "sweep",
+                         },
+                        ]),
+               "noise": (NoiseMenu, [
+                          {"key": "f",
+                           "desc": "Play filter bank (bands from 125 to 8000 Hz)",
+                           "type": "func",
+                           "val": "bank",
+                          },
+                         ]),
+              }
+
+
+def main(screen, scene):
+    scenes = [am_scene.Scene([Frame_Main(screen)], -1, name="Frame_Main")]
+    for kind in cal.STIMULI:
+        frame = stimulus_frame(kind, *MENU_EXTRAS.get(kind, ()))
+        scenes.append(am_scene.Scene([frame(screen)], -1, name=frame_name(kind)))
+    screen.play(scenes, stop_on_resize=True, start_scene=scene)
+
+
+def run():
+    """Runs the full-screen menu until the user quits."""
+    # Import scipy and medussa while the main menu is up
+    cal.prewarm()
+    last_scene = None
+    try:
+        while True:
+            try:
+                am_screen.Screen.wrapper(main, catch_interrupt=True, arguments=[last_scene])
+                return
+            except am_exceptions.ResizeScreenError as e:
+                last_scene = e.scene
+    finally:
+        cal.prerenderer.cancel()
+        cal.device_pool.close_all()
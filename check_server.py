@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2018 Christopher Brown
+#
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This script is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this script.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Checks the control server's replies, without sound.
+
+    Usage: python check_server.py
+
+    Runs calibrate_server.serve on a free port with the null backend, sends
+    it requests over TCP, and checks the replies: queued, started and
+    finished for a stimulus, cancelled and stopped for a queue that is
+    stopped, a stimulus preempted, and errors for bad requests (after which
+    the connection must still be served). Exits with status 1 if any check
+    fails.
+"""
+
+import sys
+import json
+import asyncio
+
+import calibrate as cal
+import calibrate_server
+
+TIMEOUT = 10.   # s to wait for each reply
+
+
+class Client(object):
+    """A connection to the server, which sorts the replies by request id."""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.replies = {}
+
+    async def send(self, msg):
+        self.writer.write((json.dumps(msg) + "\n").encode("utf8"))
+        await self.writer.drain()
+
+    async def reply(self, msg_id):
+        """Returns the next reply to request msg_id."""
+        while not self.replies.get(msg_id):
+            line = await asyncio.wait_for(self.reader.readline(), TIMEOUT)
+            if not line:
+                raise ConnectionError("the server closed the connection")
+            reply = json.loads(line.decode("utf8"))
+            self.replies.setdefault(reply.get("id"), []).append(reply)
+        return self.replies[msg_id].pop(0)
+
+
+async def expect(client, msg_id, events, stopped=False):
+    """Returns whether the next replies to msg_id are events, in order, printing each.
+
+        A "finished" reply must also say whether the stimulus was stopped.
+    """
+    ok = True
+    for event in events:
+        try:
+            reply = await client.reply(msg_id)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            reply = {"event": u"none ({:})".format(type(e).__name__)}
+        received = reply["event"]
+        if received == "finished":
+            received += u" (stopped)" if reply["stopped"] else u""
+        expected = event + (u" (stopped)" if event == "finished" and stopped else u"")
+        print(u"{:>4}  {:<22}{:<22}{:}".format("-" if msg_id is None else msg_id, expected, received, "ok" if received == expected else "FAIL"))
+        ok = ok and received == expected
+    return ok
+
+
+async def check(address):
+    """Sends the requests to the server at address, and returns whether every reply was as expected."""
+    host, port = address.rsplit(":", 1)
+    client = Client(*(await asyncio.open_connection(host, int(port))))
+    short = {"stimulus": "tone", "duration": .2}
+    long = {"stimulus": "tone", "duration": 60}
+    results = []
+    print(u"{:>4}  {:<22}{:<22}".format("id", "expected", "received"))
+
+    await client.send({"id": 1, "command": "ping"})
+    results.append(await expect(client, 1, ["pong"]))
+
+    await client.send(dict(short, id=2))
+    results.append(await expect(client, 2, ["queued", "started", "finished"]))
+
+    # Bad requests, each followed by a ping, to check the connection is still served
+    bad = [{"stimulus": ["tone"]}, {"stimulus": "kazoo"}, {"stimulus": "tone", "frequency": "high"},
+           {"stimulus": "tone", "pitch": 500}, {"command": "dance"}]
+    for msg_id, msg in enumerate(bad, 3):
+        await client.send(dict(msg, id=msg_id))
+        results.append(await expect(client, msg_id, ["error"]))
+        await client.send({"id": 10, "command": "ping"})
+        results.append(await expect(client, 10, ["pong"]))
+    # Not an object, so the error can't have an id
+    await client.send([1, 2])
+    results.append(await expect(client, None, ["error"]))
+
+    # A stimulus playing and another queued, then stopped
+    await client.send(dict(long, id=11))
+    await client.send(dict(short, id=12))
+    results.append(await expect(client, 11, ["queued", "started"]))
+    results.append(await expect(client, 12, ["queued"]))
+    await client.send({"id": 13, "command": "stop"})
+    results.append(await expect(client, 12, ["cancelled"]))
+    results.append(await expect(client, 13, ["stopped"]))
+    results.append(await expect(client, 11, ["finished"], stopped=True))
+
+    # A stimulus preempted by another
+    await client.send(dict(long, id=21))
+    results.append(await expect(client, 21, ["queued", "started"]))
+    await client.send(dict(short, id=22, preempt=True))
+    results.append(await expect(client, 22, ["queued"]))
+    results.append(await expect(client, 21, ["finished"], stopped=True))
+    results.append(await expect(client, 22, ["started", "finished"]))
+
+    client.writer.close()
+    return all(results)
+
+
+async def run():
+    listening = asyncio.get_running_loop().create_future()
+    server = asyncio.ensure_future(calibrate_server.serve(port=0, ready=listening.set_result))
+    try:
+        address = await asyncio.wait_for(asyncio.shield(listening), TIMEOUT)
+        print(u"Server listening on {:}".format(address))
+        return await check(address)
+    finally:
+        server.cancel()
+        try:
+            await server
+        except asyncio.CancelledError:
+            pass
+
+
+def main():
+    cal.use_backend(cal.NullBackend())
+    cal.set_timing_log(None)
+    try:
+        ok = asyncio.run(run())
+    finally:
+        cal.prerenderer.cancel()
+    print(u"All replies as expected" if ok else u"Some replies were not as expected")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
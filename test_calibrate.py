@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for calibrate. Run with: python -m pytest test_calibrate.py"""
+
+import pytest
+
+import calibrate as cal
+
+
+def clicks(**options):
+    return dict(cal.defaults("clicks"), **options)
+
+
+@pytest.mark.parametrize("options, message", [
+    ({"repetition": 0}, "repetition rate"),
+    ({"repetition": -10}, "repetition rate"),
+    ({"width": -1}, "width"),
+    ({"duration": 0}, "duration"),
+    ({"duration": 1e-6}, "duration"),
+    ({"rate": 0}, "sample rate"),
+])
+def test_click_source_rejects_bad_options(options, message):
+    with pytest.raises(ValueError, match=message):
+        cal.click_source(clicks(**options))
+
+
+def test_click_source_continuous_ignores_duration():
+    blocks, total, peak, text = cal.click_source(clicks(duration=0, continuous=1))
+    assert total is None
+    assert len(next(blocks)) > 0
+
+
+def test_click_source_length():
+    blocks, total, peak, text = cal.click_source(clicks(duration=.5))
+    assert total == int(.5 * cal.defaults("clicks")["rate"])
+    assert sum(len(block) for block in blocks) == total